@@ -0,0 +1,8 @@
+"""
+Benchmarks for the Account Service
+
+Scripts in this package drive a running service over HTTP and report
+throughput and latency percentiles. Run them with python -m, e.g.:
+
+    python -m benchmarks.asgi_vs_wsgi --help
+"""
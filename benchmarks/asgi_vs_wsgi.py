@@ -0,0 +1,62 @@
+"""
+ASGI vs WSGI benchmark
+
+Compares throughput and tail latency of the WSGI (Flask) and ASGI serving
+modes under concurrent load. Create the schema with `flask db-init`, then start both servers against
+the same database:
+
+    gunicorn --bind 0.0.0.0:8000 service:app
+    uvicorn --port 8001 service.asgi:app
+
+then run:
+
+    python -m benchmarks.asgi_vs_wsgi --wsgi http://localhost:8000 --asgi http://localhost:8001
+"""
+import argparse
+import json
+import random
+from benchmarks.common import http_request, print_table, run_load
+
+
+def seed(base_url, count):
+    """Creates count Accounts and returns their ids"""
+    ids = []
+    for number in range(count):
+        account = {
+            "name": f"Bench {number}",
+            "email": f"bench-{random.getrandbits(48):x}@example.com",
+            "address": "1 Benchmark Way",
+            "phone_number": "555-0100",
+            "date_joined": "2024-01-01",
+        }
+        status_code, body = http_request("POST", f"{base_url}/accounts", account)
+        if status_code == 201:
+            ids.append(json.loads(body)["id"])
+    return ids
+
+
+def main():
+    """Runs the benchmark and prints a comparison table"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wsgi", default="http://localhost:8000", help="base URL of the WSGI server")
+    parser.add_argument("--asgi", default="http://localhost:8001", help="base URL of the ASGI server")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--accounts", type=int, default=200, help="accounts to seed")
+    args = parser.parse_args()
+
+    ids = seed(args.wsgi, args.accounts)
+    scenarios = {
+        "read one": lambda base: http_request("GET", f"{base}/accounts/{random.choice(ids)}")[0],
+        "list page": lambda base: http_request("GET", f"{base}/accounts?limit=50")[0],
+    }
+    rows = []
+    for scenario, call in scenarios.items():
+        for mode, base_url in (("wsgi", args.wsgi), ("asgi", args.asgi)):
+            result = run_load(lambda base_url=base_url, call=call: call(base_url), args.requests, args.concurrency)
+            rows.append(dict(result, scenario=scenario, mode=mode))
+    print_table(rows, ["scenario", "mode", "requests", "errors", "throughput", "p50_ms", "p95_ms", "p99_ms"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Shared helpers for the benchmark scripts
+"""
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+def percentile(samples, fraction):
+    """Returns the nearest-rank percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def http_request(method, url, body=None, headers=None):
+    """Sends one request and returns (status code, response body)"""
+    data = None
+    headers = dict(headers or {})
+    if body is not None:
+        data = json.dumps(body).encode("utf8")
+        headers.setdefault("Content-Type", "application/json")
+    request = Request(url, data=data, headers=headers, method=method)
+    try:
+        with urlopen(request) as response:
+            return response.status, response.read()
+    except HTTPError as error:
+        return error.code, error.read()
+
+
+def run_load(call, total, concurrency):
+    """
+    Runs call() total times from concurrency threads
+
+    call must return an HTTP status code; anything >= 400 counts as an error.
+    Returns a summary with throughput and p50/p95/p99 latency in milliseconds.
+    """
+    def timed(_):
+        start = time.perf_counter()
+        try:
+            ok = call() < 400
+        except OSError:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(total)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency * 1000 for latency, _ in results]
+    return {
+        "requests": total,
+        "errors": sum(1 for _, ok in results if not ok),
+        "seconds": round(elapsed, 3),
+        "throughput": round(total / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+    }
+
+
+def print_table(rows, columns):
+    """Prints a list of dictionaries as an aligned text table"""
+    widths = [max(len(str(column)), *(len(str(row.get(column, ""))) for row in rows)) for column in columns]
+    print("  ".join(str(column).ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row.get(column, "")).ljust(width) for column, width in zip(columns, widths)))
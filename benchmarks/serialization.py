@@ -0,0 +1,76 @@
+"""
+Serialization benchmark
+
+Compares the two ways a list of Accounts can be serialized: loading Account
+objects and calling serialize() with the stdlib encoder, or selecting plain
+rows and encoding them with the configured JSON provider (orjson when it is
+installed). The Accounts are created in the database at DATABASE_URI and
+removed again afterwards; other Accounts are left alone:
+
+    python -m benchmarks.serialization --rows 2000 --repeat 5
+"""
+import argparse
+import json
+import time
+from benchmarks.common import print_table
+from service import app
+from service.common.json_provider import get_provider
+from service.models import db, Account, init_db
+from tests.factories import AccountFactory
+
+
+def orm_path(after_id=None):
+    """Serializes the Accounts after after_id through hydrated objects and the stdlib encoder"""
+    accounts = Account.find_page(after_id)
+    return json.dumps([account.serialize() for account in accounts])
+
+
+def row_path(after_id=None):
+    """Serializes the Accounts after after_id as plain rows with the configured JSON provider"""
+    rows = Account.find_page(after_id, query=Account.as_rows())
+    return json.dumps([row._asdict() for row in rows], cls=get_provider())
+
+
+def best_of(function, after_id, repeat=3):
+    """Returns the fastest of several timed runs, in seconds"""
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        function(after_id)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def compare(rows=2000, repeat=3):
+    """Creates rows Accounts, times both paths and removes the Accounts again"""
+    accounts = AccountFactory.build_batch(rows, id=None)
+    db.session.add_all(accounts)
+    db.session.flush()
+    ids = [account.id for account in accounts]
+    db.session.commit()
+    try:
+        orm_time = best_of(orm_path, min(ids) - 1, repeat)
+        row_time = best_of(row_path, min(ids) - 1, repeat)
+    finally:
+        Account.delete_many([Account.id.in_(ids)])
+    return [
+        {"path": "ORM + stdlib", "ms": round(orm_time * 1000, 1), "speedup": 1.0},
+        {"path": f"rows + {get_provider().__name__}", "ms": round(row_time * 1000, 1),
+         "speedup": round(orm_time / row_time, 1)},
+    ]
+
+
+def main():
+    """Runs the benchmark and prints the timings"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2000, help="number of Accounts to serialize")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per path; the fastest is reported")
+    args = parser.parse_args()
+
+    init_db(app)
+    print_table(compare(args.rows, args.repeat), ["path", "ms", "speedup"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Startup benchmark
+
+Measures how long a fresh process takes to import the service and to
+answer its first request, which is what every worker boot, CLI command
+and test run pays. Each run uses a new interpreter so nothing is cached:
+
+    python -m benchmarks.startup --runs 5 --path "/accounts?limit=1"
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from benchmarks.common import print_table
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import service
+imported = time.perf_counter()
+response = service.app.test_client().get(sys.argv[1])
+done = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_request_ms": (done - imported) * 1000,
+    "status": response.status_code,
+}))
+"""
+
+
+def measure_startup(path="/health", environ=None):
+    """Imports the service in a new process and times its first request"""
+    env = dict(os.environ, **(environ or {}))
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT, path],
+        env=env, capture_output=True, text=True, check=True, timeout=60,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    """Runs the benchmark and prints the median and worst timings"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="number of fresh processes to time")
+    parser.add_argument("--path", default="/health", help="URL of the first request")
+    args = parser.parse_args()
+
+    runs = [measure_startup(args.path) for _ in range(args.runs)]
+    rows = [
+        {
+            "measure": measure,
+            "median_ms": round(statistics.median(run[measure] for run in runs), 1),
+            "max_ms": round(max(run[measure] for run in runs), 1),
+        }
+        for measure in ("import_ms", "first_request_ms")
+    ]
+    print_table(rows, ["measure", "median_ms", "max_ms"])
+    print(f"status codes: {sorted({run['status'] for run in runs})}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Account API benchmark suite
+
+Seeds accounts with tests.factories.AccountFactory and then drives create,
+read, batch read, list, update, patch, delete and mixed workloads against the Account
+API. Every scenario reports throughput, p50/p95/p99 latency and the average
+number of database queries per request, read from the
+http_request_db_queries histogram on /metrics.
+
+The suite talks to the Flask test client in this process by default, or to a
+local gunicorn that it starts on a free port. Both use the database at
+DATABASE_URI, and the seeded accounts are left in it:
+
+    python -m benchmarks.suite --accounts 1000 --requests 500
+    python -m benchmarks.suite --target gunicorn --concurrency 16
+    python -m benchmarks.suite --target http --url http://localhost:8000
+
+Save a run as a baseline and compare later runs against it. The suite exits
+with status 1 when a scenario has errors, loses more than --tolerance of its
+throughput, grows its p95 latency by more than --tolerance or issues more
+queries per request than the baseline:
+
+    python -m benchmarks.suite --save baseline.json
+    python -m benchmarks.suite --baseline baseline.json --tolerance 0.25
+
+With more than one gunicorn worker, /metrics adds up the workers through
+METRICS_DIR, but the other workers' samples are up to
+METRICS_WRITE_INTERVAL seconds old. That skews the per-scenario query
+counts, so the spawned server runs a single worker unless --workers says
+otherwise.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from benchmarks.common import http_request, print_table, run_load
+from service import app
+from service.common.metrics import registry
+from service.models import Account, init_db
+from tests.factories import AccountFactory
+
+SCENARIOS = ("create", "read", "batch", "list", "update", "patch", "mixed", "delete")
+
+# the number of accounts the batch scenario looks up with one GET /accounts?ids=
+BATCH_SIZE = 50
+
+# weights of the operations in the mixed scenario
+MIX = {"read": 50, "list": 20, "create": 10, "update": 10, "patch": 10}
+
+COLUMNS = ["scenario", "requests", "errors", "throughput", "p50_ms", "p95_ms", "p99_ms", "queries"]
+
+DB_QUERIES_SAMPLE = re.compile(r"^http_request_db_queries_(sum|count)\{(.*)\} (\S+)$")
+
+
+######################################################################
+#  T A R G E T S
+######################################################################
+class ClientTarget:
+    """Sends requests through the Flask test client, one client per thread"""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None):
+        """Sends one request and returns the status code"""
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+        return self._local.client.open(path, method=method, json=body).status_code
+
+    def metrics(self):
+        """Returns the service metrics in the Prometheus text format"""
+        return registry.expose()
+
+
+class HttpTarget:
+    """Sends requests to a running server"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, path, body=None):
+        """Sends one request and returns the status code"""
+        return http_request(method, self.base_url + path, body)[0]
+
+    def metrics(self):
+        """Returns the service metrics in the Prometheus text format"""
+        return http_request("GET", self.base_url + "/metrics")[1].decode("utf8")
+
+
+def db_query_totals(text):
+    """Returns (total queries, total requests) from the db query histogram"""
+    totals = {"sum": 0.0, "count": 0.0}
+    for line in text.splitlines():
+        match = DB_QUERIES_SAMPLE.match(line)
+        if match and 'route="/metrics"' not in match.group(2):
+            totals[match.group(1)] += float(match.group(3))
+    return totals["sum"], totals["count"]
+
+
+@contextlib.contextmanager
+def gunicorn_server(workers=1, timeout=30):
+    """Starts gunicorn on a free local port and yields its base URL"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    environ = dict(os.environ, GUNICORN_WORKERS=str(workers))
+    server = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}"],
+        env=environ,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if http_request("GET", base_url + "/health")[0] == 200:
+                    break
+            except OSError:
+                pass
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("gunicorn did not start")
+            time.sleep(0.1)
+        yield base_url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+######################################################################
+#  W O R K L O A D
+######################################################################
+class Workload:
+    """
+    The operations of the benchmark scenarios
+
+    Args:
+        target: a ClientTarget or HttpTarget
+        ids (list): ids of seeded accounts to read and update
+        delete_ids (list): ids of seeded accounts for the delete scenario
+    """
+
+    def __init__(self, target, ids, delete_ids=None):
+        self.target = target
+        self.ids = ids
+        self.delete_ids = list(delete_ids or [])
+        self._token = f"{random.getrandbits(32):08x}"
+        self._numbers = itertools.count()
+
+    def _body(self):
+        """Returns a new account document with a unique email"""
+        number = next(self._numbers)
+        body = AccountFactory.build(email=f"bench-{self._token}-{number}@example.com").serialize()
+        del body["id"]
+        return body
+
+    def create(self):
+        """Creates an account"""
+        return self.target.request("POST", "/accounts", self._body())
+
+    def read(self):
+        """Reads a random account"""
+        return self.target.request("GET", f"/accounts/{random.choice(self.ids)}")
+
+    def batch(self):
+        """Reads BATCH_SIZE random accounts with one request"""
+        ids = random.sample(self.ids, min(BATCH_SIZE, len(self.ids)))
+        return self.target.request("GET", f"/accounts?ids={','.join(map(str, ids))}")
+
+    def list(self):
+        """Reads a page of accounts starting at a random id"""
+        return self.target.request("GET", f"/accounts?limit=50&after_id={random.choice(self.ids) - 1}")
+
+    def update(self):
+        """Replaces a random account"""
+        return self.target.request("PUT", f"/accounts/{random.choice(self.ids)}", self._body())
+
+    def patch(self):
+        """Changes the phone number of a random account"""
+        body = {"phone_number": f"555-{random.randrange(10000):04d}"}
+        return self.target.request("PATCH", f"/accounts/{random.choice(self.ids)}", body)
+
+    def delete(self):
+        """Deletes a seeded account that nothing else touches"""
+        return self.target.request("DELETE", f"/accounts/{self.delete_ids.pop()}")
+
+    def mixed(self):
+        """Runs one operation picked with the MIX weights"""
+        operation = random.choices(list(MIX), weights=list(MIX.values()))[0]
+        return getattr(self, operation)()
+
+
+def seed(count):
+    """Creates count accounts with AccountFactory and returns their ids"""
+    token = f"{random.getrandbits(32):08x}"
+    accounts = [
+        AccountFactory.build(id=None, email=f"seed-{token}-{number}@example.com")
+        for number in range(count)
+    ]
+    return [account_id for account_id, error in Account.create_many(accounts) if error is None]
+
+
+def run_suite(target, accounts=200, requests=500, concurrency=1, scenarios=SCENARIOS):
+    """
+    Seeds the database and runs every scenario against target
+
+    Must be called inside an application context. Returns a dictionary of
+    run_load() results keyed by scenario, each with a queries entry.
+    """
+    workload = Workload(target, seed(accounts))
+    results = {}
+    for scenario in scenarios:
+        if scenario == "delete":
+            workload.delete_ids = seed(requests)
+        queries_before, requests_before = db_query_totals(target.metrics())
+        result = run_load(getattr(workload, scenario), requests, concurrency)
+        queries_after, requests_after = db_query_totals(target.metrics())
+        served = requests_after - requests_before
+        result["queries"] = round((queries_after - queries_before) / served, 2) if served else None
+        results[scenario] = result
+    return results
+
+
+######################################################################
+#  R E G R E S S I O N   C H E C K S
+######################################################################
+def find_regressions(results, baseline=None, tolerance=0.2):
+    """
+    Returns a message for every scenario that regressed against baseline
+
+    Errors always count. Throughput may drop and p95 latency may grow by
+    the tolerance fraction; queries per request may not grow at all.
+    """
+    baseline = baseline or {}
+    regressions = []
+    for scenario, result in results.items():
+        if result["errors"]:
+            regressions.append(f"{scenario}: {result['errors']} of {result['requests']} requests failed")
+        expected = baseline.get(scenario)
+        if not expected:
+            continue
+        if result["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{scenario}: throughput {result['throughput']}/s is below baseline {expected['throughput']}/s"
+            )
+        if result["p95_ms"] > expected["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{scenario}: p95 {result['p95_ms']} ms is above baseline {expected['p95_ms']} ms")
+        if None not in (result.get("queries"), expected.get("queries")) and result["queries"] > expected["queries"]:
+            regressions.append(
+                f"{scenario}: {result['queries']} queries per request is above baseline {expected['queries']}"
+            )
+    return regressions
+
+
+def main(argv=None):
+    """Runs the suite, prints a table and returns the exit status"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=("client", "gunicorn", "http"), default="client",
+                        help="where to send requests")
+    parser.add_argument("--url", default="http://localhost:8000", help="base URL for --target http")
+    parser.add_argument("--workers", type=int, default=1, help="workers for --target gunicorn")
+    parser.add_argument("--accounts", type=int, default=200, help="accounts to seed")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="concurrent clients")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="scenario to run (repeatable)")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput and p95 regression")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    init_db(app)
+
+    options = {"accounts": args.accounts, "requests": args.requests,
+               "concurrency": args.concurrency, "scenarios": args.scenario or SCENARIOS}
+    if args.target == "client":
+        results = run_suite(ClientTarget(app), **options)
+    elif args.target == "http":
+        results = run_suite(HttpTarget(args.url), **options)
+    else:
+        with gunicorn_server(args.workers) as base_url:
+            results = run_suite(HttpTarget(base_url), **options)
+
+    print_table([dict(result, scenario=scenario) for scenario, result in results.items()], COLUMNS)
+    if args.save:
+        with open(args.save, "w", encoding="utf8") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf8") as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""
+Gunicorn Configuration
+
+Gunicorn loads this file from the working directory, so the service starts
+with a plain `gunicorn` command. Every setting can be overridden from the
+environment:
+
+    PORT                         port to bind to (8000)
+    SERVER_MODE                  wsgi (Flask) or asgi (service.asgi)
+    GUNICORN_WORKER_CLASS        gthread, gevent, sync or a worker class path
+    GUNICORN_WORKERS             worker processes (sized from the CPU count)
+    GUNICORN_THREADS             threads per gthread worker (4)
+    GUNICORN_WORKER_CONNECTIONS  concurrent clients per gevent worker (1000)
+    GUNICORN_PRELOAD             load the app before forking (true, except gevent)
+    GUNICORN_TIMEOUT             seconds before a silent worker is restarted (30)
+    GUNICORN_GRACEFUL_TIMEOUT    seconds to finish requests on restart (30)
+    GUNICORN_KEEPALIVE           seconds to hold idle keep-alive connections (5)
+    GUNICORN_MAX_REQUESTS        requests before a worker is recycled (0 = never)
+    DATABASE_MAX_CONNECTIONS     connections all workers may open together (90)
+    DATABASE_POOL_SIZE           connections kept per worker (one per thread)
+    DATABASE_MAX_OVERFLOW        extra connections per worker under load (2)
+    METRICS_DIR                  directory the workers share metrics through
+                                 (a new temporary directory with several workers)
+    LOG_LEVEL                    gunicorn log level (info)
+"""
+import os
+import sys
+import multiprocessing
+import tempfile
+
+ASYNC_WORKERS = ("gevent", "eventlet", "uvicorn.workers.UvicornWorker")
+
+
+def env_int(name, default):
+    """Returns an integer environment variable"""
+    return int(os.getenv(name, str(default)))
+
+
+def env_bool(name, default):
+    """Returns a boolean environment variable"""
+    return os.getenv(name, str(default)).lower() in ("true", "yes", "1")
+
+
+def default_worker_class(server_mode):
+    """Returns the worker class for a SERVER_MODE"""
+    return "uvicorn.workers.UvicornWorker" if server_mode == "asgi" else "gthread"
+
+
+def default_workers(cpu_count, worker_class):
+    """
+    Returns the number of workers for the CPU count
+
+    Async workers multiplex many clients per process, so one per CPU is
+    enough. Blocking workers spend most of their time waiting on the
+    database, so they use the (2 x CPUs) + 1 rule of thumb.
+    """
+    if worker_class in ASYNC_WORKERS:
+        return max(1, cpu_count)
+    return cpu_count * 2 + 1
+
+
+def pool_settings(workers, threads, worker_class, max_connections, pool_size=None, max_overflow=None):
+    """
+    Returns the (pool_size, max_overflow) of each worker's database pool
+
+    Every worker has its own pool. A gthread worker never runs more than
+    `threads` queries at once, so by default its pool holds one connection
+    per thread plus a small overflow. Each pool is then capped so that
+    workers x (pool_size + max_overflow) stays within max_connections.
+    """
+    if pool_size is None:
+        pool_size = threads if worker_class == "gthread" else 5
+    if max_overflow is None:
+        max_overflow = 2 if worker_class == "gthread" else 10
+    per_worker = max(1, max_connections // workers)
+    pool_size = min(pool_size, per_worker)
+    return pool_size, max(0, min(max_overflow, per_worker - pool_size))
+
+
+######################################################################
+#  S E R V E R   S E T T I N G S
+######################################################################
+server_mode = os.getenv("SERVER_MODE", "wsgi").lower()
+
+wsgi_app = "service.asgi:app" if server_mode == "asgi" else "service:app"
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", default_worker_class(server_mode))
+workers = env_int("GUNICORN_WORKERS", default_workers(multiprocessing.cpu_count(), worker_class))
+threads = env_int("GUNICORN_THREADS", 4 if worker_class == "gthread" else 1)
+worker_connections = env_int("GUNICORN_WORKER_CONNECTIONS", 1000)
+
+# gevent must monkey-patch the standard library before the app is imported
+preload_app = env_bool("GUNICORN_PRELOAD", worker_class not in ("gevent", "eventlet"))
+
+timeout = env_int("GUNICORN_TIMEOUT", 30)
+graceful_timeout = env_int("GUNICORN_GRACEFUL_TIMEOUT", 30)
+keepalive = env_int("GUNICORN_KEEPALIVE", 5)
+max_requests = env_int("GUNICORN_MAX_REQUESTS", 0)
+max_requests_jitter = max_requests // 10
+
+# /metrics adds up the samples that every worker writes to METRICS_DIR; the
+# variable is set before the app is loaded so the workers inherit it
+if workers > 1 and not os.getenv("METRICS_DIR"):
+    os.environ["METRICS_DIR"] = os.path.join(tempfile.gettempdir(), f"accounts-metrics-{os.getpid()}")
+
+# PostgreSQL allows 100 connections by default; keep a few for other clients
+database_pool_size, database_max_overflow = pool_settings(
+    workers, threads, worker_class, env_int("DATABASE_MAX_CONNECTIONS", 90),
+    pool_size=int(os.environ["DATABASE_POOL_SIZE"]) if os.getenv("DATABASE_POOL_SIZE") else None,
+    max_overflow=int(os.environ["DATABASE_MAX_OVERFLOW"]) if os.getenv("DATABASE_MAX_OVERFLOW") else None,
+)
+# set before the app is loaded so service.config and the workers see them
+os.environ["DATABASE_POOL_SIZE"] = str(database_pool_size)
+os.environ["DATABASE_MAX_OVERFLOW"] = str(database_max_overflow)
+os.environ["GUNICORN_WORKERS"] = str(workers)
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info")
+
+
+######################################################################
+#  S E R V E R   H O O K S
+######################################################################
+def on_starting(server):  # pylint: disable=unused-argument
+    """Creates METRICS_DIR and removes the metrics an earlier server left in it"""
+    if os.getenv("METRICS_DIR"):
+        from service.common.metrics import clear_directory  # pylint: disable=import-outside-toplevel
+        os.makedirs(os.environ["METRICS_DIR"], exist_ok=True)
+        clear_directory(os.environ["METRICS_DIR"])
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Adds the counts of a worker that exited to the exited workers file"""
+    if os.getenv("METRICS_DIR"):
+        from service.common.metrics import registry  # pylint: disable=import-outside-toplevel
+        registry.mark_process_dead(os.environ["METRICS_DIR"], worker.pid)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """
+    Prepares a new worker's database access
+
+    gevent workers make psycopg2 cooperative so a query yields to other
+    greenlets instead of blocking the whole worker.
+
+    The app connects lazily, but anything that touched the database in the
+    master before forking (such as a preload hook) leaves pooled sockets
+    behind. Sockets must never be shared between processes, so each worker
+    discards the copied pool without closing the master's sockets and
+    opens its own connections.
+    """
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+        patch_psycopg()
+    if "service.models" in sys.modules:
+        from service import app  # pylint: disable=import-outside-toplevel
+        from service.models import db  # pylint: disable=import-outside-toplevel
+        for bind in [None, *(app.config.get("SQLALCHEMY_BINDS") or {})]:
+            db.get_engine(app, bind=bind).dispose(close=False)
+
+
+def post_worker_init(worker):  # pylint: disable=unused-argument
+    """Sends the Flask log messages through the gunicorn error log"""
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.common.log_handlers import init_logging  # pylint: disable=import-outside-toplevel
+    init_logging(app, "gunicorn.error")
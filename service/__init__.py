@@ -1,37 +1,74 @@
 """
 Package: service
 Package for the Account service
+
+The application is built by create_app(). Importing the package does not
+connect to the database: the engine is created on the first request that
+needs it and the schema is managed with the `flask db-init` command.
 """
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from flask import Flask, jsonify, send_from_directory
+from flask import Flask
 from flask_cors import CORS
-import os
 
-# Create Flask application
-app = Flask(__name__, static_folder='../static')
-CORS(app)  # Enable CORS for all routes
+from service import models, routes
+from service.common import cli_commands, error_handlers
+from service.common.compression import init_compression
+from service.common.idempotency import init_idempotency
+from service.common.json_provider import init_json
+from service.common.metrics import init_metrics
+from service.common.rate_limit import init_rate_limits
+from service.common.replicas import init_replicas
+
+
+def create_app(config=None):
+    """
+    Creates and configures an instance of the Account service
+
+    Args:
+        config (dict): optional settings that override service.config
+    """
+    app = Flask(__name__, static_folder='../static')
+    CORS(app, expose_headers=["Link", "ETag"])  # Enable CORS for all routes
+
+    app.config['SECRET_KEY'] = 'secret-for-dev'
+    app.config['LOGGING_LEVEL'] = 'INFO'
+    app.config.from_object('service.config')
+    if config:
+        app.config.update(config)
+
+    # Encode responses with orjson when it is installed
+    init_json(app)
+
+    # Record per-route request metrics
+    init_metrics(app)
+
+    # Compress responses for clients that accept gzip or br
+    init_compression(app)
+
+    # Refuse noisy clients and shed load before the database pool runs dry
+    init_rate_limits(app)
+
+    # Replay the responses of retried POST requests
+    init_idempotency(app)
+
+    # Register the database without connecting to it
+    models.init_app(app)
 
-app.config['SECRET_KEY'] = 'secret-for-dev'
-app.config['LOGGING_LEVEL'] = 'INFO'
+    # Send the reads of GET requests to read replicas when there are any
+    init_replicas(app)
 
-# Set up logging for production
-print('Setting up logging for {}...'.format(__name__))
-app.logger.info('Logging established')
+    app.register_blueprint(routes.api)
+    app.register_blueprint(error_handlers.errors)
+    app.register_blueprint(cli_commands.commands)
 
-# Initialize the database
-from service import models
+    app.logger.info('Account service created')
+    return app
 
-try:
-    models.init_db(app)
-except Exception as e:
-    app.logger.critical('Database initialization failed: %s', e)
-    sys.exit(4)
 
-# Import routes last to avoid circular import
-from service import routes
+app = create_app()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,286 @@
+"""
+ASGI Account Service
+
+An alternative asynchronous entry point for the Account REST API. The hot
+reads (GET /health, GET /accounts and GET /accounts/<id>) run in async
+handlers on an async database driver (asyncpg for PostgreSQL, aiosqlite for
+SQLite), so a slow query only suspends the request that issued it instead of
+blocking a whole worker.
+
+Every other request is forwarded to the Flask app through asgiref's
+WsgiToAsgi adapter, so writes, bulk imports, exports and the rest keep the
+validation, cache invalidation, idempotency keys and rate limits of the WSGI
+service. Without asgiref those routes answer 501 Not Implemented.
+
+Run it with:
+    uvicorn service.asgi:app
+or through gunicorn with SERVER_MODE=asgi.
+"""
+import json
+import logging
+import re
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlencode
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+from werkzeug.routing import RequestRedirect
+from service import app as flask_app
+from service.models import Account
+from service.common import status
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:  # pragma: no cover
+    WsgiToAsgi = None
+
+logger = logging.getLogger("flask.app")
+
+
+class HttpError(Exception):
+    """Aborts a request with an HTTP status code and message"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Request:
+    """The parts of an ASGI HTTP request that the handlers need"""
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True)
+        self.args = {name: values[-1] for name, values in query.items()}
+        self.headers = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in scope.get("headers", [])
+        }
+        self.body = body
+
+    def get_int_arg(self, name, default=None, minimum=0, maximum=Account.MAX_ID):
+        """Returns an integer query parameter or aborts with 400_BAD_REQUEST"""
+        value = self.args.get(name)
+        if value is None or value == "":
+            return default
+        try:
+            number = int(value)
+        except ValueError:
+            number = None
+        if number is None or not minimum <= number <= maximum:
+            raise HttpError(
+                status.HTTP_400_BAD_REQUEST,
+                f"Query parameter [{name}] must be an integer from {minimum} to {maximum}",
+            )
+        return number
+
+    def etag_matches(self, header, etag):
+        """Returns True if an If-Match/If-None-Match header lists etag"""
+        tags = [tag.strip() for tag in self.headers.get(header, "").split(",")]
+        return "*" in tags or f'"{etag}"' in tags or f'W/"{etag}"' in tags
+
+
+######################################################################
+#  A S Y N C   A C C O U N T   S E R V I C E
+######################################################################
+class AsyncAccountService:
+    """
+    ASGI application for the Account API
+
+    Args:
+        database_uri (str): an SQLAlchemy URI with an async driver
+        engine_options (dict): keyword arguments for create_async_engine
+        page_size (int): the default number of Accounts per page
+        max_page_size (int): the largest page a client may ask for
+        wsgi_app (Flask): the app that serves the routes with no async
+            handler; they answer 501 if asgiref is not installed
+    """
+
+    ROUTES = [
+        ("/health", {"GET": "health"}),
+        ("/accounts", {"GET": "list_accounts"}),
+        (r"/accounts/(?P<account_id>\d+)", {"GET": "get_account"}),
+    ]
+    # the query parameters a handler understands; requests with others
+    # (?sort=, ?fields=, ?stream=, ...) go to the Flask app
+    HANDLER_ARGS = {
+        "list_accounts": frozenset(["after_id", "limit", "name", "name_prefix", "email"]),
+    }
+
+    def __init__(self, database_uri, engine_options=None, page_size=100, max_page_size=1000, wsgi_app=None):
+        self.database_uri = database_uri
+        self.engine_options = dict(engine_options or {})
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.engine = None
+        self.session_factory = None
+        self.routes = [(re.compile(pattern + "$"), methods) for pattern, methods in self.ROUTES]
+        self.wsgi_app = wsgi_app
+        self.fallback = WsgiToAsgi(wsgi_app) if wsgi_app is not None and WsgiToAsgi is not None else None
+        if wsgi_app is not None and self.fallback is None:
+            logger.warning("asgiref is not installed: routes without an async handler answer 501")
+
+    @classmethod
+    def from_config(cls, config, wsgi_app=None):
+        """Creates the service from the Flask configuration"""
+        return cls(
+            config["ASYNC_DATABASE_URI"],
+            config.get("SQLALCHEMY_ENGINE_OPTIONS"),
+            config["ACCOUNTS_PAGE_SIZE"],
+            config["ACCOUNTS_MAX_PAGE_SIZE"],
+            wsgi_app,
+        )
+
+    def session(self):
+        """Returns a new AsyncSession, creating the engine on first use"""
+        if self.engine is None:
+            logger.info("Creating async engine")
+            self.engine = create_async_engine(self.database_uri, **self.engine_options)
+            self.session_factory = sessionmaker(
+                self.engine, class_=AsyncSession, expire_on_commit=False
+            )
+        return self.session_factory()
+
+    async def shutdown(self):
+        """Closes every pooled connection"""
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    ##################################################################
+    # ASGI protocol
+    ##################################################################
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            request = Request(scope, b"")
+            if self.fallback is not None and self._match(request) is None:
+                await self.fallback(scope, receive, send)
+                return
+            more_body = True
+            while more_body:
+                message = await receive()
+                request.body += message.get("body", b"")
+                more_body = message.get("more_body", False)
+            status_code, payload, headers = await self.dispatch(request)
+            await self._respond(send, status_code, payload, headers)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.session()  # create the engine before the first request
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def _respond(send, status_code, payload, headers):
+        raw_headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]
+        body = b""
+        if payload is not None:
+            body = json.dumps(payload).encode("utf8")
+            raw_headers.append((b"content-type", b"application/json"))
+        raw_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": status_code, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": body})
+
+    def _match(self, request):
+        """Returns (handler, arguments) for the async handler of a request, or None"""
+        for pattern, methods in self.routes:
+            match = pattern.match(request.path)
+            if match and request.method in methods:
+                name = methods[request.method]
+                known = self.HANDLER_ARGS.get(name)
+                if self.wsgi_app is not None and known is not None and not known.issuperset(request.args):
+                    return None
+                return getattr(self, name), match.groupdict()
+        return None
+
+    async def dispatch(self, request):
+        """Routes a request to its handler and turns errors into JSON"""
+        try:
+            route = self._match(request)
+            if route is None:
+                raise self._not_served(request)
+            handler, arguments = route
+            return await handler(request, **arguments)
+        except HttpError as error:
+            return self._error(error.status_code, str(error))
+
+    def _not_served(self, request):
+        """Returns the error for a request that no async handler serves"""
+        if self.wsgi_app is None:
+            if any(pattern.match(request.path) for pattern, _ in self.routes):
+                return HttpError(
+                    status.HTTP_405_METHOD_NOT_ALLOWED,
+                    f"The method {request.method} is not allowed for this URL.",
+                )
+            return HttpError(status.HTTP_404_NOT_FOUND, "The requested URL was not found on the server.")
+        # tell a route the Flask app has apart from one that does not exist
+        try:
+            self.wsgi_app.url_map.bind("localhost").match(request.path, method=request.method)
+        except (NotFound, MethodNotAllowed) as error:
+            return HttpError(error.code, error.description)
+        except RequestRedirect:
+            pass
+        return HttpError(
+            status.HTTP_501_NOT_IMPLEMENTED,
+            f"{request.method} {request.path} is only served by the WSGI app; install asgiref to forward it",
+        )
+
+    @staticmethod
+    def _error(status_code, message):
+        logger.warning(message)
+        body = {"status": status_code, "error": HTTPStatus(status_code).phrase, "message": message}
+        return status_code, body, {}
+
+    ##################################################################
+    # Handlers
+    ##################################################################
+    async def health(self, request):  # pylint: disable=unused-argument
+        """Health Status"""
+        return status.HTTP_200_OK, {"status": "OK"}, {}
+
+    async def list_accounts(self, request):
+        """Lists Accounts one keyset page at a time, like GET /accounts"""
+        after_id = request.get_int_arg("after_id")
+        limit = request.get_int_arg("limit", self.page_size, minimum=1)
+        limit = min(limit, self.max_page_size)
+        criteria = Account.search_criteria(
+            name=request.args.get("name"),
+            name_prefix=request.args.get("name_prefix"),
+            email=request.args.get("email"),
+        )
+        statement = select(Account).where(*criteria).order_by(Account.id).limit(limit + 1)
+        if after_id is not None:
+            statement = statement.where(Account.id > after_id)
+        async with self.session() as session:
+            accounts = (await session.execute(statement)).scalars().all()
+
+        account_list = [account.serialize() for account in accounts[:limit]]
+        headers = {}
+        if len(accounts) > limit:
+            args = dict(request.args, after_id=account_list[-1]["id"], limit=limit)
+            headers["Link"] = f'</accounts?{urlencode(args)}>; rel="next"'
+        return status.HTTP_200_OK, account_list, headers
+
+    async def get_account(self, request, account_id):
+        """Reads an Account, like GET /accounts/<id>"""
+        async with self.session() as session:
+            account = await session.get(Account, int(account_id))
+        if account is None:
+            raise HttpError(status.HTTP_404_NOT_FOUND, f"Account with id [{account_id}] could not be found.")
+        etag = account.etag()
+        headers = {"ETag": f'"{etag}"'}
+        if request.etag_matches("if-none-match", etag):
+            return status.HTTP_304_NOT_MODIFIED, None, headers
+        return status.HTTP_200_OK, account.serialize(), headers
+
+
+app = AsyncAccountService.from_config(flask_app.config, flask_app)
@@ -0,0 +1,261 @@
+"""
+Record Cache
+
+This module contains a small read-through cache for database records.
+Values are kept in an in-process LRU with a time to live and a size bound,
+and can optionally be shared between processes through a CacheBackend.
+CACHE_BACKEND_URL selects the shared backend; Redis is used when the redis
+package is installed.
+"""
+import itertools
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+
+######################################################################
+#  S H A R E D   B A C K E N D S
+######################################################################
+class CacheBackend:
+    """Interface for a cache that is shared between processes (e.g. Redis)"""
+
+    def get(self, key):
+        """Returns the value stored under key or None"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """Stores value under key for ttl seconds"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Removes key from the cache"""
+        raise NotImplementedError
+
+    def clear(self):
+        """Removes every key from the cache"""
+        raise NotImplementedError
+
+
+class InMemoryBackend(CacheBackend):
+    """A local stand-in for a shared cache backend"""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self._clock():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (self._clock() + ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisBackend(CacheBackend):
+    """
+    A cache shared between processes through Redis
+
+    Args:
+        url (str): the Redis URL, e.g. redis://localhost:6379/0
+        prefix (str): prepended to every key so clear() only removes ours
+    """
+
+    def __init__(self, url, prefix="accounts:"):
+        if redis is None:
+            raise RuntimeError("The redis package must be installed to use a Redis cache backend")
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        self._client.set(self.prefix + key, pickle.dumps(value), px=max(1, int(ttl * 1000)))
+
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self._client.scan_iter(match=self.prefix + "*"):
+            self._client.delete(key)
+
+
+def make_backend(url):
+    """Returns the shared backend for a CACHE_BACKEND_URL, or None for no URL"""
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError(f"Unknown cache backend [{url}], must be a redis:// URL")
+
+
+######################################################################
+#  R E C O R D   C A C H E
+######################################################################
+# generations are kept in the shared backend under this prefix
+GENERATION_PREFIX = "generation:"
+
+# passed to set() by callers that do not check the generation
+ANY_GENERATION = object()
+
+
+class RecordCache:
+    """
+    A thread-safe LRU cache with a time to live
+
+    Every delete() gives its key a new generation. A caller that reads
+    generation() before loading a value and passes it to set() does not cache
+    the value if the key was invalidated while it was loading.
+
+    Args:
+        maxsize (int): the maximum number of entries kept in process
+        ttl (float): the number of seconds an entry stays valid
+        backend (CacheBackend): an optional cache shared between processes
+        local_ttl (float): the number of seconds an entry is kept in process;
+            defaults to ttl, or to 0 (no local copies) with a backend, since
+            an invalidation cannot reach the local copies of other processes
+    """
+
+    def __init__(self, maxsize=1024, ttl=30, backend=None, clock=time.monotonic, local_ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        if local_ttl is None:
+            local_ttl = 0 if backend else ttl
+        self.local_ttl = local_ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        # the generation of each recently deleted key; keys evicted from here,
+        # or never deleted, share the newest evicted generation
+        self._generations = OrderedDict()
+        self._generation_floor = 0
+        self._next_generation = itertools.count(1)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the value cached under key or None on a miss"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+        value = self.backend.get(key) if self.backend else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, value)
+        return value
+
+    def generation(self, key):
+        """Returns a token that changes every time key is invalidated"""
+        if self.backend:
+            return self.backend.get(GENERATION_PREFIX + key)
+        with self._lock:
+            return self._local_generation(key)
+
+    def set(self, key, value, generation=ANY_GENERATION):
+        """
+        Caches value under key and returns True
+
+        If generation is given, nothing is cached and False is returned when
+        key was invalidated after generation() returned it.
+        """
+        if self.backend:
+            if not self._current(key, generation):
+                return False
+            self.backend.set(key, value, self.ttl)
+            # a delete that ran while the value was stored may have missed it
+            if not self._current(key, generation):
+                self.backend.delete(key)
+                return False
+        with self._lock:
+            if not self.backend and generation is not ANY_GENERATION and generation != self._local_generation(key):
+                return False
+            self._store(key, value)
+        return True
+
+    def delete(self, key):
+        """Invalidates key in this process and in the shared backend"""
+        with self._lock:
+            self._data.pop(key, None)
+            if not self.backend:
+                self._generations[key] = next(self._next_generation)
+                self._generations.move_to_end(key)
+                while len(self._generations) > self.maxsize:
+                    _, self._generation_floor = self._generations.popitem(last=False)
+        if self.backend:
+            # the generation changes before the value goes so set() sees one or the other
+            self.backend.set(GENERATION_PREFIX + key, uuid.uuid4().hex, self.ttl)
+            self.backend.delete(key)
+
+    def _local_generation(self, key):
+        """Returns the generation of key in this process (lock held)"""
+        return self._generations.get(key, self._generation_floor)
+
+    def _current(self, key, generation):
+        """Returns True if key has not been invalidated since generation (shared backend)"""
+        return generation is ANY_GENERATION or self.backend.get(GENERATION_PREFIX + key) == generation
+
+    def clear(self):
+        """Invalidates every key"""
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+            self._generation_floor = next(self._next_generation)
+        if self.backend:
+            self.backend.clear()
+
+    def stats(self):
+        """Returns the cache counters as a dictionary"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
+
+    def _store(self, key, value):
+        """Adds an entry and evicts the least recently used ones (lock held)"""
+        if self.local_ttl <= 0:
+            return
+        self._data[key] = (self._clock() + self.local_ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
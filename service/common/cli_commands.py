@@ -1,8 +1,13 @@
 """
 Flask CLI Command Extensions
 """
-from service import app
-from service.models import db
+import click
+from flask import Blueprint, current_app
+from service.models import db, Account
+from service.common.importer import AccountImporter, ImportFailed, read_records
+
+# Registered by create_app(); cli_group=None puts the commands at the top level
+commands = Blueprint("commands", __name__, cli_group=None)
 
 
 ######################################################################
@@ -10,7 +15,7 @@ from service.models import db
 # Usage:
 #   flask db-create
 ######################################################################
-@app.cli.command("db-create")
+@commands.cli.command("db-create")
 def db_create():
     """
     Recreates a local database. You probably should not use this on
@@ -19,3 +24,75 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to create any missing tables and indexes
+# Usage:
+#   flask db-init
+######################################################################
+@commands.cli.command("db-init")
+def db_init():
+    """
+    Creates the tables and indexes that do not exist yet. Existing tables
+    and data are left untouched, so this is safe to run on every deploy.
+    """
+    db.create_all()
+    Account.create_indexes()
+
+
+######################################################################
+# Command to add indexes missing from an existing database
+# Usage:
+#   flask db-indexes
+######################################################################
+@commands.cli.command("db-indexes")
+def db_indexes():
+    """
+    Creates any indexes that are missing from tables made by an older
+    release. Existing tables and data are left untouched.
+    """
+    Account.create_indexes()
+
+
+######################################################################
+# Command to import Accounts from a CSV or NDJSON file
+# Usage:
+#   flask accounts-import accounts.csv [--start-line N]
+######################################################################
+@commands.cli.command("accounts-import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["csv", "ndjson"]),
+              help="File format, taken from the file extension by default.")
+@click.option("--batch-size", type=click.IntRange(min=1),
+              help="Rows per COPY or INSERT, ACCOUNTS_BULK_BATCH_SIZE by default.")
+@click.option("--start-line", type=click.IntRange(min=1), default=1, show_default=True,
+              help="Line of the file to start from, to resume a failed import.")
+@click.option("--skip-invalid", is_flag=True,
+              help="Report invalid records and carry on instead of stopping.")
+def accounts_import(path, file_format, batch_size, start_line, skip_invalid):
+    """
+    Streams Accounts from a CSV or NDJSON file into the database. Records
+    are validated like POST /accounts and loaded in batches, with COPY on
+    PostgreSQL. Each batch is committed, so a failed import can be resumed
+    with --start-line.
+    """
+    if file_format is None:
+        file_format = "ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"
+    importer = AccountImporter(
+        batch_size or current_app.config["ACCOUNTS_BULK_BATCH_SIZE"],
+        skip_invalid,
+        progress=click.echo,
+    )
+    with open(path, newline="", encoding="utf8") as stream:
+        try:
+            result = importer.run(read_records(stream, file_format, start_line))
+        except ImportFailed as error:
+            raise click.ClickException(
+                f"{error}\nImported {importer.imported} rows. "
+                f"Fix the file and resume with --start-line {error.line}"
+            ) from error
+    click.echo(
+        f"Imported {result['imported']} rows, skipped {result['skipped']}, "
+        f"in {result['seconds']}s ({result['rows_per_second']:,.0f} rows/sec)"
+    )
@@ -0,0 +1,70 @@
+"""
+Response Compression
+
+This module compresses responses for clients that send Accept-Encoding.
+Brotli is used when it is installed and the client prefers it, gzip
+otherwise. Only complete responses of an allowed content type and at least
+COMPRESS_MIN_SIZE bytes are compressed; streamed responses are left alone
+because the exports compress themselves as they go.
+"""
+import gzip
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+def choose_encoding(accept_encodings):
+    """Returns "br", "gzip" or None for the request's Accept-Encoding"""
+    gzip_quality = accept_encodings["gzip"]
+    if brotli is not None and accept_encodings["br"] and accept_encodings["br"] >= gzip_quality:
+        return "br"
+    return "gzip" if gzip_quality else None
+
+
+def compress(data, encoding, level):
+    """Compresses data with the named encoding at a 1-9 gzip level"""
+    if encoding == "br":
+        # Brotli qualities run from 0 to 11; 4-5 matches gzip -6 for speed
+        return brotli.compress(data, quality=min(11, max(0, level - 2)))
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _should_compress(response, config):
+    if response.status_code != 200 or "Content-Encoding" in response.headers:
+        return False
+    if response.mimetype not in config["COMPRESS_MIMETYPES"]:
+        return False
+    # files are sent with direct_passthrough but still have a known length
+    length = response.content_length
+    if length is None or (response.is_streamed and not response.direct_passthrough):
+        return False
+    return length >= config["COMPRESS_MIN_SIZE"]
+
+
+def compress_response(response):
+    """Compresses the response body if the client and content allow it"""
+    config = current_app.config
+    if not _should_compress(response, config):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    response.direct_passthrough = False
+    response.set_data(compress(response.get_data(), encoding, config["COMPRESS_LEVEL"]))
+    response.headers["Content-Encoding"] = encoding
+    response.headers.pop("Accept-Ranges", None)  # ranges would apply to the encoded bytes
+    # the encoded body is a different representation of the same resource
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    """Compresses the responses of app"""
+    app.after_request(compress_response)
@@ -1,22 +1,48 @@
 """
 Module: error_handlers
 """
-from flask import jsonify
-from service.models import DataValidationError
-from service import app
+from flask import Blueprint, current_app as app, jsonify
+from sqlalchemy.exc import IntegrityError
+from service.models import DataValidationError, db
 from . import status
 
+# Registered by create_app() so the handlers apply to every request
+errors = Blueprint("errors", __name__)
+
 
 ######################################################################
 # Error Handlers
 ######################################################################
-@app.errorhandler(DataValidationError)
+@errors.app_errorhandler(DataValidationError)
 def request_validation_error(error):
     """Handles Value Errors from bad data"""
     return bad_request(error)
 
 
-@app.errorhandler(status.HTTP_400_BAD_REQUEST)
+@errors.app_errorhandler(IntegrityError)
+def integrity_error(error):
+    """Handles unique constraint violations with 409_CONFLICT"""
+    db.session.rollback()
+    message = str(error.orig)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+    )
+
+
+@errors.app_errorhandler(status.HTTP_409_CONFLICT)
+def conflict(error):
+    """Handles requests that conflict with the state of the resource with 409_CONFLICT"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+    )
+
+
+@errors.app_errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad requests with 400_BAD_REQUEST"""
     message = str(error)
@@ -29,7 +55,7 @@ def bad_request(error):
     )
 
 
-@app.errorhandler(status.HTTP_404_NOT_FOUND)
+@errors.app_errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
     """Handles resources not found with 404_NOT_FOUND"""
     message = str(error)
@@ -40,7 +66,7 @@ def not_found(error):
     )
 
 
-@app.errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+@errors.app_errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
 def method_not_supported(error):
     """Handles unsupported HTTP methods with 405_METHOD_NOT_SUPPORTED"""
     message = str(error)
@@ -55,7 +81,7 @@ def method_not_supported(error):
     )
 
 
-@app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+@errors.app_errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """Handles unsupported media requests with 415_UNSUPPORTED_MEDIA_TYPE"""
     message = str(error)
@@ -70,7 +96,22 @@ def mediatype_not_supported(error):
     )
 
 
-@app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
+@errors.app_errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """Handles stale If-Match requests with 412_PRECONDITION_FAILED"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+
+@errors.app_errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
     message = str(error)
@@ -85,7 +126,7 @@ def internal_server_error(error):
     )
 
 
-@app.errorhandler(status.HTTP_401_UNAUTHORIZED)
+@errors.app_errorhandler(status.HTTP_401_UNAUTHORIZED)
 def unauthorized(error):
     """Handles unauthorized requests with 401_UNAUTHORIZED"""
     message = str(error)
@@ -94,3 +135,33 @@ def unauthorized(error):
         jsonify(status=status.HTTP_401_UNAUTHORIZED, error="Unauthorized", message=message),
         status.HTTP_401_UNAUTHORIZED,
     )
+
+
+@errors.app_errorhandler(status.HTTP_429_TOO_MANY_REQUESTS)
+def too_many_requests(error):
+    """Handles rate limited requests with 429_TOO_MANY_REQUESTS"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_429_TOO_MANY_REQUESTS, error="Too Many Requests", message=message),
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        retry_after_header(error),
+    )
+
+
+@errors.app_errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """Handles shed requests with 503_SERVICE_UNAVAILABLE"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_503_SERVICE_UNAVAILABLE, error="Service Unavailable", message=message),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        retry_after_header(error),
+    )
+
+
+def retry_after_header(error):
+    """Returns the Retry-After header of an HTTP exception, if it has one"""
+    retry_after = getattr(error, "retry_after", None)
+    return {"Retry-After": str(retry_after)} if retry_after else {}
@@ -0,0 +1,61 @@
+"""
+Export Helpers
+
+This module contains generators that turn database rows into CSV or NDJSON
+text and optionally gzip it on the fly. Rows are consumed one at a time and
+written out in chunks of about CHUNK_SIZE characters, so an export of any
+size uses a constant amount of memory.
+"""
+import csv
+import io
+import zlib
+from flask import json
+
+CHUNK_SIZE = 64 * 1024
+
+
+def chunked(pieces, size=CHUNK_SIZE):
+    """Joins small strings into chunks of at least size characters"""
+    buffer = []
+    length = 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def csv_lines(columns, rows):
+    """Yields a CSV header line and then one line per row"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in _with_header(columns, rows):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _with_header(columns, rows):
+    yield columns
+    yield from rows
+
+
+def ndjson_lines(records):
+    """Yields one JSON document per line for each dictionary"""
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+
+def gzip_chunks(chunks, level=6):
+    """Compresses text chunks into a gzip stream as they are produced"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf8"))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,154 @@
+"""
+Idempotency Keys
+
+This module lets clients retry POST requests safely. A request sent with
+an Idempotency-Key header runs once; its response is kept in a bounded
+store with a time to live and replayed for every retry with the same key,
+without running the view again. Retries that arrive while the first request
+is still running wait for it instead of starting a second one.
+
+With several worker processes the store must be shared through
+CACHE_BACKEND_URL, or a retry that reaches another worker runs again.
+"""
+import functools
+import hashlib
+import logging
+import threading
+from flask import Response, abort, current_app, request
+from service.common import status
+from service.common.cache import RecordCache, make_backend
+from service.common.rate_limit import RateLimiter
+
+logger = logging.getLogger("flask.app")
+
+MAX_KEY_LENGTH = 255
+
+# headers that are recomputed for every response instead of replayed
+SKIPPED_HEADERS = frozenset(["content-length", "date", "server-timing"])
+
+
+class IdempotencyStore:
+    """
+    Remembers the responses of requests by idempotency key
+
+    Args:
+        maxsize (int): the number of responses kept in process
+        ttl (float): the number of seconds a response is kept
+        backend (CacheBackend): an optional store shared between processes;
+            concurrent duplicates are only coalesced within one process
+        wait (float): the number of seconds a retry waits for the request
+            it duplicates
+        max_body (int): the largest response body kept, in bytes; a retry of
+            a request with a larger response gets 409 instead of a replay
+    """
+
+    def __init__(self, maxsize=10000, ttl=86400, backend=None, wait=30, max_body=65536):
+        self.responses = RecordCache(maxsize=maxsize, ttl=ttl, backend=backend)
+        self.wait = wait
+        self.max_body = max_body
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fingerprint, handler):
+        """
+        Returns the stored response for key, or calls handler() to make it
+
+        Args:
+            key (str): the scoped idempotency key
+            fingerprint (str): a hash of the request, which must match the
+                one the response was stored with
+            handler (callable): returns the Response for the first request
+        """
+        while True:
+            stored = self.responses.get(key)
+            if stored is not None:
+                return self._replay(stored, fingerprint)
+            with self._lock:
+                done = self._pending.get(key)
+                if done is None:
+                    done = self._pending[key] = threading.Event()
+                    break
+            if not done.wait(self.wait):
+                abort(status.HTTP_409_CONFLICT, "A request with this Idempotency-Key is still in progress")
+
+        try:
+            # the first request may have finished between get() and taking the key
+            stored = self.responses.get(key)
+            if stored is not None:
+                return self._replay(stored, fingerprint)
+            response = handler()
+            if response.status_code < 500 and not response.is_streamed:
+                self.responses.set(key, self._stored(response, fingerprint))
+            return response
+        finally:
+            with self._lock:
+                del self._pending[key]
+            done.set()
+
+    def _stored(self, response, fingerprint):
+        """Returns what is kept of a response; the body only if it fits in max_body"""
+        body = response.get_data()
+        return {
+            "fingerprint": fingerprint,
+            "status": response.status_code,
+            "headers": [
+                (name, value) for name, value in response.headers
+                if name.lower() not in SKIPPED_HEADERS
+            ],
+            "body": body.decode("utf8") if len(body) <= self.max_body else None,
+        }
+
+    @staticmethod
+    def _replay(stored, fingerprint):
+        """Rebuilds a stored response"""
+        if stored["fingerprint"] != fingerprint:
+            abort(status.HTTP_409_CONFLICT, "Idempotency-Key was already used for a different request")
+        if stored["body"] is None:
+            abort(status.HTTP_409_CONFLICT, "A request with this Idempotency-Key already ran; "
+                  "its response was too large to keep")
+        response = Response(stored["body"], stored["status"], stored["headers"])
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+
+def idempotent(view):
+    """Makes a view replay its response for requests with a known Idempotency-Key"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        store = current_app.extensions.get("idempotency")
+        if not key or store is None:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            abort(status.HTTP_400_BAD_REQUEST, f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+        # keys are scoped to the client and endpoint that sent them
+        scoped_key = f"idempotency:{RateLimiter.client_key()}:{request.method} {request.path}:{key}"
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        return store.run(
+            scoped_key, fingerprint, lambda: current_app.make_response(view(*args, **kwargs))
+        )
+
+    return wrapper
+
+
+def init_idempotency(app, backend=None):
+    """Sets up the idempotency key store of app (size 0 disables it)"""
+    size = app.config.get("IDEMPOTENCY_KEYS_SIZE", 0)
+    if size > 0:
+        if backend is None:
+            backend = make_backend(app.config.get("CACHE_BACKEND_URL"))
+        if backend is None and app.config.get("WORKERS", 1) > 1:
+            logger.warning(
+                "Idempotency keys are kept per process with %d workers: set CACHE_BACKEND_URL "
+                "so a retry that reaches another worker is replayed", app.config["WORKERS"]
+            )
+        app.extensions["idempotency"] = IdempotencyStore(
+            maxsize=size,
+            ttl=app.config.get("IDEMPOTENCY_KEYS_TTL", 86400),
+            backend=backend,
+            wait=app.config.get("IDEMPOTENCY_KEYS_WAIT", 30),
+            max_body=app.config.get("IDEMPOTENCY_MAX_BODY", 65536),
+        )
+    else:
+        app.extensions.pop("idempotency", None)
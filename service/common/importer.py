@@ -0,0 +1,135 @@
+"""
+Import Helpers
+
+This module streams Accounts from CSV or NDJSON files into the database.
+Records are read one line at a time, validated with Account.deserialize and
+loaded in batches with Account.load_many, so files of any size can be
+imported in constant memory. Every batch is committed on its own and a
+failure reports the line to resume from.
+"""
+import csv
+import json
+import time
+from sqlalchemy.exc import SQLAlchemyError
+from service.models import db, Account, DataValidationError
+
+
+class ImportFailed(Exception):
+    """Raised when an import stops; line is where it can be resumed"""
+
+    def __init__(self, line, message):
+        super().__init__(message)
+        self.line = line
+
+
+def read_records(stream, file_format, start_line=1):
+    """
+    Yields (line number, record) for every record at or after start_line
+
+    CSV files must have a header row; empty cells are treated as missing
+    fields. NDJSON lines that are not valid JSON yield a
+    DataValidationError instead of a record.
+    """
+    if file_format == "csv":
+        yield from _read_csv(stream, start_line)
+        return
+    for line_number, line in enumerate(stream, 1):
+        if line_number < start_line or not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as error:
+            yield line_number, DataValidationError(f"Invalid Account: line is not valid JSON - {error}")
+
+
+def _read_csv(stream, start_line):
+    reader = csv.DictReader(stream)
+    if reader.fieldnames is None:  # reads the header row
+        return
+    while True:
+        line_number = reader.line_num + 1
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        if line_number >= start_line:
+            yield line_number, {key: value for key, value in row.items() if value != ""}
+
+
+class AccountImporter:
+    """
+    Validates records and loads them into the account table in batches
+
+    Args:
+        batch_size (int): the number of rows per COPY or INSERT
+        skip_invalid (bool): report invalid records and carry on instead
+            of stopping at the first one
+        progress (callable): called with a progress message after each batch
+    """
+
+    COLUMNS = [column.key for column in Account.__table__.columns if not column.primary_key]
+
+    def __init__(self, batch_size=1000, skip_invalid=False, progress=None):
+        self.batch_size = batch_size
+        self.skip_invalid = skip_invalid
+        self.progress = progress or (lambda message: None)
+        self.imported = 0
+        self.skipped = 0
+        self.started = None
+        self._batch = []
+        self._batch_line = None
+
+    @property
+    def rate(self):
+        """Returns the number of rows imported per second so far"""
+        elapsed = time.perf_counter() - self.started if self.started else 0
+        return self.imported / elapsed if elapsed else 0.0
+
+    def run(self, records):
+        """Imports (line number, record) pairs and returns the import totals"""
+        self.started = time.perf_counter()
+        for line_number, record in records:
+            try:
+                if isinstance(record, DataValidationError):
+                    raise record
+                account = Account().deserialize(record)
+            except DataValidationError as error:
+                self._invalid(line_number, error)
+                continue
+            if not self._batch:
+                self._batch_line = line_number
+            self._batch.append({column: getattr(account, column) for column in self.COLUMNS})
+            if len(self._batch) >= self.batch_size:
+                self._flush(next_line=line_number + 1)
+        self._flush()
+        return {
+            "imported": self.imported,
+            "skipped": self.skipped,
+            "seconds": round(time.perf_counter() - self.started, 3),
+            "rows_per_second": round(self.rate, 1),
+        }
+
+    def _invalid(self, line_number, error):
+        if not self.skip_invalid:
+            self._flush()  # keep the valid records before the bad one
+            raise ImportFailed(line_number, f"Line {line_number}: {error}")
+        self.skipped += 1
+        self.progress(f"Skipped line {line_number}: {error}")
+
+    def _flush(self, next_line=None):
+        if not self._batch:
+            return
+        try:
+            self.imported += Account.load_many(self._batch)
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            raise ImportFailed(
+                self._batch_line,
+                f"Batch starting at line {self._batch_line} failed: {getattr(error, 'orig', None) or error}",
+            ) from error
+        finally:
+            self._batch = []
+        message = f"Imported {self.imported} rows at {self.rate:,.0f} rows/sec"
+        if next_line:
+            message += f", next line {next_line}"
+        self.progress(message)
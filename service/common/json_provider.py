@@ -0,0 +1,56 @@
+"""
+JSON Provider
+
+This module contains the JSON encoders used for every response. Dates are
+written as ISO 8601 strings so rows can be serialized without converting
+each date first, and orjson is used when it is installed because it is
+several times faster than the standard library on large lists.
+"""
+from datetime import date
+from flask import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class StdlibJSONEncoder(json.JSONEncoder):
+    """The standard library encoder with ISO 8601 dates"""
+
+    def default(self, o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return super().default(o)
+
+
+class OrjsonJSONEncoder(StdlibJSONEncoder):
+    """Encodes with orjson, which handles dates natively"""
+
+    def encode(self, o):
+        # orjson has no indentation width, so pretty printing uses the stdlib
+        if self.indent is not None:
+            return super().encode(o)
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(o, default=self.default, option=option).decode("utf8")
+
+
+PROVIDERS = {"stdlib": StdlibJSONEncoder}
+if orjson is not None:
+    PROVIDERS["orjson"] = OrjsonJSONEncoder
+
+
+def get_provider(name="auto"):
+    """Returns the encoder class for a JSON_PROVIDER setting"""
+    if name == "auto":
+        return PROVIDERS.get("orjson", StdlibJSONEncoder)
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown JSON provider [{name}], must be one of {sorted(PROVIDERS)}")
+    return PROVIDERS[name]
+
+
+def init_json(app):
+    """Sets the JSON encoder that jsonify() and json.dumps() use for app"""
+    app.json_encoder = get_provider(app.config.get("JSON_PROVIDER", "auto"))
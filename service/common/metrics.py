@@ -0,0 +1,489 @@
+"""
+Metrics
+
+This module contains a small Prometheus-style metrics registry and the
+request hooks that record per-route latency, status codes, in-flight
+requests and database queries for every request. The hooks also add a
+Server-Timing header with the query count and time of each response, log
+slow queries and log statements that one request repeats many times, the
+usual sign of an N+1 query pattern.
+
+The registry lives in each process. Under gunicorn with several workers,
+set METRICS_DIR to a directory the workers share: each worker writes its
+samples there every METRICS_WRITE_INTERVAL seconds, and /metrics adds up
+the samples of every worker, so a scrape sees the whole server whichever
+worker answers it. The samples of other workers can be up to one interval
+old. When a worker exits its counters are added to one file for all exited
+workers and its own file is removed. Without METRICS_DIR a scrape only sees
+the worker that answered it.
+
+Streamed responses run their queries after the view returns, so they are
+recorded once the body has been sent.
+"""
+import atexit
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter as StatementCounter
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Prometheus' default latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger("flask.app")
+
+
+######################################################################
+#  M E T R I C   T Y P E S
+######################################################################
+class Metric:
+    """Base class for a metric family with a fixed set of label names"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        """Returns the label values in labelnames order"""
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        """Formats label values as {name="value",...}"""
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        inner = ",".join(
+            '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in pairs
+        )
+        return "{" + inner + "}"
+
+    def expose(self, others=()):
+        """
+        Returns the metric family in the Prometheus text format
+
+        Args:
+            others (list): the samples() of other processes to add in
+        """
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        values = {tuple(key): value for key, value in self.combine(self.samples(), *others)}
+        for key in sorted(values):
+            lines.extend(self._sample_lines(key, values[key]))
+        return lines
+
+    def combine(self, *samples):
+        """Adds up several samples() lists into one"""
+        values = {}
+        for pairs in samples:
+            for key, value in pairs:
+                key = tuple(key)
+                values[key] = self._add(values[key], value) if key in values else value
+        return [[list(key), value] for key, value in values.items()]
+
+    def samples(self):
+        """Returns a copy of every sample as [label values, value] pairs"""
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._values.items()]
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def _add(total, value):
+        return total + value
+
+    def _sample_lines(self, key, value):
+        return [f"{self.name}{self._format_labels(key)} {value}"]
+
+    def clear(self):
+        """Removes every recorded sample"""
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increments the counter for the given labels"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Returns the current value for the given labels"""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    """A value that goes up and down"""
+
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        """Decrements the gauge for the given labels"""
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Counts observations in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Records one observation for the given labels"""
+        key = self._key(labels)
+        with self._lock:
+            sample = self._values.get(key)
+            if sample is None:
+                sample = self._values[key] = {
+                    "buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0
+                }
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample["buckets"][index] += 1
+            sample["count"] += 1
+            sample["sum"] += value
+
+    def get(self, **labels):
+        """Returns a copy of the (buckets, count, sum) sample for the labels"""
+        with self._lock:
+            sample = self._values.get(self._key(labels))
+            return dict(sample, buckets=list(sample["buckets"])) if sample else None
+
+    @staticmethod
+    def _copy(value):
+        return dict(value, buckets=list(value["buckets"]))
+
+    @staticmethod
+    def _add(total, value):
+        return {
+            "buckets": [a + b for a, b in zip(total["buckets"], value["buckets"])],
+            "count": total["count"] + value["count"],
+            "sum": total["sum"] + value["sum"],
+        }
+
+    def _sample_lines(self, key, value):
+        lines = []
+        for bound, count in zip(self.buckets, value["buckets"]):
+            labels = self._format_labels(key, ("le", repr(float(bound))))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+        labels = self._format_labels(key, ("le", "+Inf"))
+        lines.append(f"{self.name}_bucket{labels} {value['count']}")
+        lines.append(f"{self.name}_count{self._format_labels(key)} {value['count']}")
+        lines.append(f"{self.name}_sum{self._format_labels(key)} {value['sum']}")
+        return lines
+
+
+class Registry:
+    """A collection of metrics that can be exposed together"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+        self._writer_pid = None
+
+    def register(self, metric):
+        """Adds a metric to the registry and returns it"""
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self, directory=None):
+        """
+        Returns every metric in the Prometheus text format
+
+        Args:
+            directory (str): a METRICS_DIR whose samples from other processes
+                are added to the samples of this process
+        """
+        others = self._read_others(directory) if directory else []
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose([snapshot.get(metric.name, []) for snapshot in others]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory, pid=None):
+        """Writes the samples of this process to directory"""
+        snapshot = {metric.name: metric.samples() for metric in self._metrics}
+        _write_snapshot(_snapshot_path(directory, pid or os.getpid()), snapshot)
+
+    def start_writer(self, directory, interval=1.0):
+        """Writes the samples of this process to directory every interval seconds"""
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            # a forked worker starts its own writer; threads do not survive fork
+            self._writer_pid = os.getpid()
+        thread = threading.Thread(
+            target=self._write_forever, args=(directory, interval), name="metrics-writer", daemon=True
+        )
+        thread.start()
+        atexit.register(self._try_write, directory)
+
+    def _write_forever(self, directory, interval):
+        while True:
+            self._try_write(directory)
+            time.sleep(interval)
+
+    def _try_write(self, directory):
+        try:
+            self.write(directory)
+        except OSError as error:
+            logger.warning("Could not write metrics to %s: %s", directory, error)
+
+    def mark_process_dead(self, directory, pid):
+        """
+        Adds the counts of a process that exited to those of earlier ones
+
+        Its gauges are dropped and its file is removed, so the directory
+        holds one file per live worker and one for every worker that exited.
+        Only the gunicorn master calls this, so the file is never shared.
+        """
+        path = _snapshot_path(directory, pid)
+        try:
+            with open(path, encoding="utf-8") as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            return
+        exited_path = _snapshot_path(directory, EXITED)
+        try:
+            with open(exited_path, encoding="utf-8") as file:
+                exited = json.load(file)
+        except (OSError, ValueError):
+            exited = {}
+        for metric in self._metrics:
+            if metric.kind != "gauge" and metric.name in snapshot:
+                exited[metric.name] = metric.combine(exited.get(metric.name, []), snapshot[metric.name])
+        _write_snapshot(exited_path, exited)
+        os.remove(path)
+
+    @staticmethod
+    def _read_others(directory):
+        """Returns the snapshots that other processes wrote to directory"""
+        snapshots = []
+        own = _snapshot_path(directory, os.getpid())
+        for path in glob.glob(os.path.join(directory, "metrics-*.json")):
+            if path == own:
+                continue  # this process exposes its live values instead
+            try:
+                with open(path, encoding="utf-8") as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError) as error:
+                logger.warning("Skipping unreadable metrics file %s: %s", path, error)
+        return snapshots
+
+    def clear(self):
+        """Removes every recorded sample"""
+        for metric in self._metrics:
+            metric.clear()
+
+
+# the file that holds the counts of every worker that exited
+EXITED = "exited"
+
+
+def _snapshot_path(directory, pid):
+    return os.path.join(directory, f"metrics-{pid}.json")
+
+
+def _write_snapshot(path, snapshot):
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(snapshot, file)
+    os.replace(path + ".tmp", path)  # readers never see a partial file
+
+
+def clear_directory(directory):
+    """Removes the samples left in directory by an earlier server"""
+    for path in glob.glob(os.path.join(directory, "metrics-*.json*")):
+        os.remove(path)
+
+
+######################################################################
+#  S E R V I C E   M E T R I C S
+######################################################################
+registry = Registry()
+
+REQUEST_COUNT = registry.register(Counter(
+    "http_requests_total",
+    "Total HTTP requests by method, route and status code",
+    ("method", "route", "status"),
+))
+REQUEST_LATENCY = registry.register(Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by method, route and status code",
+    ("method", "route", "status"),
+))
+REQUESTS_IN_FLIGHT = registry.register(Gauge(
+    "http_requests_in_flight",
+    "HTTP requests currently being served by method and route",
+    ("method", "route"),
+))
+REQUESTS_LIMITED = registry.register(Counter(
+    "http_requests_limited_total",
+    "HTTP requests refused by the rate limiter (rate) or load shedding (overload)",
+    ("method", "route", "reason"),
+))
+DB_LOOKUPS_COALESCED = registry.register(Counter(
+    "db_lookups_coalesced_total",
+    "Record lookups that shared the result of an identical lookup already in flight",
+    ("lookup",),
+))
+DB_QUERIES = registry.register(Histogram(
+    "http_request_db_queries",
+    "Database statements issued per HTTP request by method and route",
+    ("method", "route"),
+    buckets=QUERY_COUNT_BUCKETS,
+))
+DB_TIME = registry.register(Histogram(
+    "http_request_db_seconds",
+    "Time spent in database statements per HTTP request by method and route",
+    ("method", "route"),
+))
+
+
+def route_label():
+    """Returns the URL rule that matched the request, e.g. /accounts/<int:account_id>"""
+    return request.url_rule.rule if request.url_rule else "<unmatched>"
+
+
+def _before_request():
+    directory = current_app.config.get("METRICS_DIR")
+    if directory:
+        registry.start_writer(directory, current_app.config.get("METRICS_WRITE_INTERVAL", 1.0))
+    g.metrics_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_time = 0.0
+    g.db_statements = StatementCounter()
+    g.metrics_route = route_label()
+    REQUESTS_IN_FLIGHT.inc(method=request.method, route=g.metrics_route)
+
+
+def _after_request(response):
+    if "metrics_start" in g:
+        if current_app.config.get("SERVER_TIMING", True):
+            elapsed = time.perf_counter() - g.metrics_start
+            response.headers["Server-Timing"] = server_timing(g.db_queries, g.db_time, elapsed)
+        record = functools.partial(
+            _record_request, g._get_current_object(),  # pylint: disable=protected-access
+            request.method, response.status_code, current_app.config.get("N_PLUS_ONE_THRESHOLD", 0),
+        )
+        if response.is_streamed:
+            # the body runs its queries after this hook, so count them once it is sent
+            response.call_on_close(record)
+        else:
+            record()
+    return response
+
+
+def _record_request(metrics, method, status_code, threshold):
+    """Records the latency and queries of a request from its g"""
+    labels = {"method": method, "route": metrics.metrics_route}
+    elapsed = time.perf_counter() - metrics.metrics_start
+    REQUEST_COUNT.inc(status=status_code, **labels)
+    REQUEST_LATENCY.observe(elapsed, status=status_code, **labels)
+    DB_QUERIES.observe(metrics.db_queries, **labels)
+    DB_TIME.observe(metrics.db_time, **labels)
+    _check_repeated_statements(metrics, method, threshold)
+
+
+def _teardown_request(error=None):  # pylint: disable=unused-argument
+    if "metrics_route" in g:
+        REQUESTS_IN_FLIGHT.dec(method=request.method, route=g.metrics_route)
+
+
+def server_timing(queries, db_seconds, total_seconds):
+    """Formats the Server-Timing header value for a response"""
+    noun = "query" if queries == 1 else "queries"
+    return (
+        f'db;desc="{queries} {noun}";dur={db_seconds * 1000:.2f}, '
+        f"total;dur={total_seconds * 1000:.2f}"
+    )
+
+
+def _check_repeated_statements(metrics, method, threshold):
+    """Logs the statement a request repeated at least N_PLUS_ONE_THRESHOLD times"""
+    if not threshold or not metrics.db_statements:
+        return
+    statement, count = metrics.db_statements.most_common(1)[0]
+    if count >= threshold:
+        logger.warning(
+            "Possible N+1 queries on %s %s: %s executions of %s",
+            method, metrics.metrics_route, count, statement,
+        )
+
+
+def _log_slow_query(statement, elapsed):
+    if not has_app_context():
+        return
+    threshold = current_app.config.get("SLOW_QUERY_MS", 0)
+    if threshold and elapsed * 1000 >= threshold:
+        if has_request_context():
+            where = f"{request.method} {g.get('metrics_route', route_label())}"
+        else:
+            where = "outside a request"
+        logger.warning("Slow query on %s took %.1f ms: %s", where, elapsed * 1000, statement)
+
+
+# pylint: disable=unused-argument,too-many-arguments
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # keyed by execution context so a statement that fails cannot leave a
+    # start time behind for the next one
+    conn.info.setdefault("query_start", {})[context] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _record_query(conn, context, statement)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # a failed statement never reaches after_cursor_execute
+    if context.connection is not None:
+        _record_query(context.connection, context.execution_context, context.statement)
+
+
+def _record_query(conn, context, statement):
+    """Counts a statement and its time for the current request"""
+    start = conn.info.get("query_start", {}).pop(context, None)
+    if start is None:
+        return  # the statement failed before it was sent
+    elapsed = time.perf_counter() - start
+    if has_request_context() and "db_queries" in g:
+        g.db_queries += 1
+        g.db_time += elapsed
+        g.db_statements[statement] += 1
+    _log_slow_query(statement, elapsed)
+
+
+def init_metrics(app):
+    """Records request metrics for every request served by app"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,140 @@
+"""
+Rate Limiting and Load Shedding
+
+This module contains a token-bucket rate limiter keyed by client and route,
+and a limit on concurrent requests that sheds load with 503 before the
+database pool runs out of connections. Clients are identified by their
+X-API-Key header, or by their address when they do not send one. Buckets
+are kept in process by default and can be kept in a BucketBackend shared
+between processes instead.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from service.common.metrics import REQUESTS_LIMITED, route_label
+
+
+######################################################################
+#  B U C K E T   B A C K E N D S
+######################################################################
+class BucketBackend:
+    """Interface for token buckets that are shared between processes (e.g. Redis)"""
+
+    def take(self, key, rate, burst, cost=1):
+        """
+        Takes cost tokens from the bucket under key
+
+        A new bucket starts full with burst tokens and refills at rate
+        tokens per second.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the number of
+            seconds until they will be available
+        """
+        raise NotImplementedError
+
+
+class InMemoryBuckets(BucketBackend):
+    """
+    Token buckets kept in this process
+
+    Args:
+        maxsize (int): the number of buckets kept; the least recently used
+            ones are dropped, which refills them
+    """
+
+    def __init__(self, maxsize=10000, clock=time.monotonic):
+        self.maxsize = maxsize
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        with self._lock:
+            now = self._clock()
+            tokens, updated = self._data.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            self._data[key] = (tokens, now)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return wait
+
+
+######################################################################
+#  R A T E   L I M I T E R
+######################################################################
+class RateLimiter:
+    """
+    Rate limits and sheds the requests of a Flask app
+
+    Args:
+        app (Flask): the app to limit, or None to call init_app() later
+        backend (BucketBackend): where the token buckets are kept
+    """
+
+    def __init__(self, app=None, backend=None):
+        self.backend = backend or InMemoryBuckets()
+        self.slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Checks every request of app against the limits in its config"""
+        limit = app.config.get("MAX_CONCURRENT_REQUESTS", 0)
+        self.slots = threading.BoundedSemaphore(limit) if limit > 0 else None
+        app.extensions["rate_limiter"] = self
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    @staticmethod
+    def client_key():
+        """Returns the API key (hashed) or the address the request came from"""
+        api_key = request.headers.get("X-API-Key")
+        if api_key:
+            return "key:" + hashlib.sha256(api_key.encode("utf8")).hexdigest()[:16]
+        return f"addr:{request.remote_addr}"
+
+    def _before_request(self):
+        config = current_app.config
+        route = route_label()
+        if route in config.get("RATE_LIMIT_EXEMPT", ()):
+            return
+        labels = {"method": request.method, "route": route}
+        rate, burst = config.get("RATE_LIMIT_ROUTES", {}).get(
+            f"{request.method} {route}",
+            (config.get("RATE_LIMIT_PER_SECOND", 0), config.get("RATE_LIMIT_BURST", 1)),
+        )
+        if rate > 0:
+            wait = self.backend.take(f"{self.client_key()}:{request.method} {route}", rate, burst)
+            if wait:
+                REQUESTS_LIMITED.inc(reason="rate", **labels)
+                raise TooManyRequests(
+                    f"Rate limit of {rate:g} requests per second exceeded",
+                    retry_after=max(1, math.ceil(wait)),
+                )
+        if self.slots is not None:
+            if not self.slots.acquire(blocking=False):
+                REQUESTS_LIMITED.inc(reason="overload", **labels)
+                raise ServiceUnavailable(
+                    "The service is overloaded, try again shortly",
+                    retry_after=config.get("LOAD_SHED_RETRY_AFTER", 1),
+                )
+            g.request_slot = True
+
+    def _teardown_request(self, error=None):  # pylint: disable=unused-argument
+        if g.pop("request_slot", False):
+            self.slots.release()
+
+
+def init_rate_limits(app, backend=None):
+    """Rate limits and sheds the requests of app"""
+    return RateLimiter(app, backend)
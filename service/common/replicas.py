@@ -0,0 +1,268 @@
+"""
+Read Replica Routing
+
+This module sends the reads of GET and HEAD requests to read replicas and
+everything else to the primary database. Replicas are used round-robin and
+checked every REPLICA_CHECK_INTERVAL seconds; a replica that cannot be
+reached, or that lags the primary by more than REPLICA_MAX_LAG seconds, is
+skipped until a later check passes; only one thread checks a replica at a
+time. A client that has just written reads from the primary for
+READ_YOUR_WRITES_SECONDS so it sees its own changes: the write is remembered
+by the worker that served it and in a signed cookie, which every worker
+honours when the client sends it back.
+
+Replicas are Flask-SQLAlchemy binds named replica0, replica1, ... that are
+built from DATABASE_REPLICA_URIS, so they get the same engine options and
+pool metrics as the primary.
+"""
+import itertools
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, has_app_context, request
+from flask_sqlalchemy import SignallingSession, get_state
+from itsdangerous import BadSignature, TimestampSigner
+from sqlalchemy import event, orm, text
+from sqlalchemy.exc import SQLAlchemyError
+from service.common.pool_metrics import MeteredSQLAlchemy
+from service.common.rate_limit import RateLimiter
+
+logger = logging.getLogger("flask.app")
+
+READ_METHODS = frozenset(["GET", "HEAD"])
+
+# whether a PostgreSQL standby has replayed all the WAL it received, and the
+# seconds since the last transaction it replayed
+POSTGRES_LAG = text(
+    "SELECT pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() AS caught_up, "
+    "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) AS seconds"
+)
+
+# signed cookie that sends a client's reads to the primary on every worker
+# for READ_YOUR_WRITES_SECONDS after it wrote
+WRITE_COOKIE = "recent_write"
+
+
+######################################################################
+#  R O U T I N G   S E S S I O N
+######################################################################
+class RoutingSession(SignallingSession):
+    """A session that runs plain SELECTs on the replica chosen for the request"""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = current_replica()
+        if replica is not None and not self._flushing and _is_plain_select(clause):
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+def current_replica():
+    """Returns the replica engine chosen for the current request, or None"""
+    return g.get("db_replica") if has_app_context() else None
+
+
+def reads_own_writes():
+    """Returns True while the client of the current request must see its own recent writes"""
+    return g.get("db_read_own_writes", False) if has_app_context() else False
+
+
+def _is_plain_select(clause):
+    """Returns True for a SELECT that takes no row locks"""
+    return getattr(clause, "is_select", False) and getattr(clause, "_for_update_arg", None) is None
+
+
+class RoutingSQLAlchemy(MeteredSQLAlchemy):
+    """Flask-SQLAlchemy extension whose sessions route reads to replicas"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+######################################################################
+#  R E P L I C A   R O U T E R
+######################################################################
+class Replica:
+    """The health of one replica bind"""
+
+    def __init__(self, bind):
+        self.bind = bind
+        self.healthy = True
+        self.lag = None
+        self.checked = None
+        self.checking = False
+
+    def stats(self):
+        """Returns the replica health as a dictionary"""
+        return {"bind": self.bind, "healthy": self.healthy, "lag": self.lag}
+
+
+class ReplicaRouter:
+    """
+    Chooses the database for each request
+
+    Args:
+        app (Flask): the app whose DATABASE_REPLICA_URIS are routed to
+        clock (callable): returns the current time in seconds
+    """
+
+    def __init__(self, app, clock=time.monotonic):
+        self.app = app
+        self._clock = clock
+        uris = app.config.get("DATABASE_REPLICA_URIS") or []
+        binds = {
+            key: uri for key, uri in (app.config.get("SQLALCHEMY_BINDS") or {}).items()
+            if not key.startswith("replica")
+        }
+        binds.update((f"replica{number}", uri) for number, uri in enumerate(uris))
+        app.config["SQLALCHEMY_BINDS"] = binds
+        self.replicas = [Replica(f"replica{number}") for number in range(len(uris))]
+        self._turn = itertools.count()
+        self._writes = OrderedDict()
+        self._lock = threading.Lock()
+        self._listening = set()
+
+    def engine(self, replica):
+        """Returns the engine of a replica, created on first use"""
+        engine = get_state(self.app).db.get_engine(self.app, bind=replica.bind)
+        if engine not in self._listening:
+            event.listen(engine, "handle_error", lambda context: self._failed(replica, context))
+            self._listening.add(engine)
+        return engine
+
+    def choose(self):
+        """Returns the engine of the next healthy replica, or None for the primary"""
+        if not self.replicas:
+            return None
+        start = next(self._turn)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if self._claim_check(replica):
+                try:
+                    self.check(replica)
+                finally:
+                    replica.checking = False
+            if replica.healthy:
+                return self.engine(replica)
+        return None
+
+    def _claim_check(self, replica):
+        """Returns True if a replica is due a check and no other thread is running it"""
+        interval = self.app.config.get("REPLICA_CHECK_INTERVAL", 5)
+        with self._lock:
+            if replica.checking or (replica.checked is not None and self._clock() - replica.checked < interval):
+                return False
+            replica.checking = True
+            return True
+
+    def check(self, replica):
+        """Connects to a replica and measures its replication lag"""
+        replica.checked = self._clock()
+        try:
+            with self.engine(replica).connect() as connection:
+                replica.lag = self.lag(connection)
+        except SQLAlchemyError as error:
+            if replica.healthy:
+                logger.warning("Replica %s is unavailable: %s", replica.bind, error)
+            replica.healthy = False
+            return
+        max_lag = self.app.config.get("REPLICA_MAX_LAG", 0)
+        replica.healthy = not (max_lag and replica.lag is not None and replica.lag > max_lag)
+        if not replica.healthy:
+            logger.warning("Replica %s is %.1f seconds behind, reading from the primary", replica.bind, replica.lag)
+
+    @staticmethod
+    def lag(connection):
+        """Returns how many seconds a replica is behind, or None if unknown"""
+        if connection.dialect.name == "postgresql":
+            row = connection.execute(POSTGRES_LAG).first()
+            if row.caught_up:
+                # nothing left to replay: the primary is idle, not the replica slow
+                return 0.0
+            return None if row.seconds is None else float(row.seconds)
+        connection.execute(text("SELECT 1"))
+        return None
+
+    def _failed(self, replica, context):
+        """Takes a replica out of rotation after a lost connection"""
+        if context.is_disconnect:
+            logger.warning("Lost the connection to replica %s", replica.bind)
+            replica.healthy = False
+            replica.checked = self._clock()
+
+    def record_write(self, client):
+        """Sends the reads of client to the primary for a while"""
+        with self._lock:
+            self._writes.pop(client, None)
+            self._writes[client] = self._clock()
+            while len(self._writes) > self.app.config.get("READ_YOUR_WRITES_CLIENTS", 10000):
+                self._writes.popitem(last=False)
+
+    def wrote_recently(self, client):
+        """Returns True if client wrote within READ_YOUR_WRITES_SECONDS"""
+        with self._lock:
+            written = self._writes.get(client)
+        window = self.app.config.get("READ_YOUR_WRITES_SECONDS", 5)
+        return written is not None and self._clock() - written < window
+
+    def _signer(self):
+        return TimestampSigner(self.app.secret_key, salt=WRITE_COOKIE)
+
+    def set_write_cookie(self, response):
+        """Tells every worker to read from the primary for the client of response"""
+        window = self.app.config.get("READ_YOUR_WRITES_SECONDS", 5)
+        if window > 0:
+            response.set_cookie(
+                WRITE_COOKIE, self._signer().sign(WRITE_COOKIE).decode(),
+                max_age=math.ceil(window), httponly=True, samesite="Lax",
+            )
+
+    def has_write_cookie(self):
+        """Returns True if the request carries a valid cookie from a recent write"""
+        cookie = request.cookies.get(WRITE_COOKIE)
+        if not cookie:
+            return False
+        try:
+            self._signer().unsign(cookie, max_age=self.app.config.get("READ_YOUR_WRITES_SECONDS", 5))
+        except BadSignature:
+            return False
+        return True
+
+    def stats(self):
+        """Returns the health of every replica"""
+        return [replica.stats() for replica in self.replicas]
+
+
+def _before_request():
+    router = current_app.extensions["replicas"]
+    g.db_replica = None
+    g.db_read_own_writes = False
+    if router.replicas and request.method in READ_METHODS:
+        if router.wrote_recently(RateLimiter.client_key()) or router.has_write_cookie():
+            g.db_read_own_writes = True
+        else:
+            g.db_replica = router.choose()
+
+
+def _after_request(response):
+    router = current_app.extensions["replicas"]
+    if router.replicas and request.method not in READ_METHODS and response.status_code < 400:
+        router.record_write(RateLimiter.client_key())
+        router.set_write_cookie(response)
+    return response
+
+
+def _teardown_request(error=None):  # pylint: disable=unused-argument
+    g.pop("db_replica", None)
+    g.pop("db_read_own_writes", None)
+
+
+def init_replicas(app):
+    """Routes the reads of app to the replicas in DATABASE_REPLICA_URIS"""
+    if "replicas" not in app.extensions:
+        app.before_request(_before_request)
+        app.after_request(_after_request)
+        app.teardown_request(_teardown_request)
+    app.extensions["replicas"] = ReplicaRouter(app)
+    return app.extensions["replicas"]
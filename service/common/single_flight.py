@@ -0,0 +1,70 @@
+"""
+Single-Flight Lookups
+
+This module merges identical lookups that are in flight at the same time.
+The first caller for a key runs the lookup; callers that arrive while it is
+still running wait for it and share its result (or its exception) instead of
+sending the same query to the database again. Nothing is kept once the
+lookup finishes, so this is not a cache: the next call runs a fresh lookup.
+Lookups are only merged within one process.
+"""
+import threading
+from service.common.metrics import DB_LOOKUPS_COALESCED
+
+
+class _Call:
+    """A lookup in flight and the callers waiting for it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs each lookup once for all of its concurrent callers
+
+    Args:
+        name (str): the lookup label used in the coalesced requests metric
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """
+        Returns (result, shared) for function(), running it once per key
+
+        shared is True for callers that waited for another caller's result.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            DB_LOOKUPS_COALESCED.inc(lookup=self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function()
+        except Exception as error:  # pylint: disable=broad-except
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self):
+        """Returns the number of lookups currently running"""
+        with self._lock:
+            return len(self._calls)
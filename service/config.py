@@ -1,6 +1,7 @@
 """
 Global Configuration for Application
 """
+import json
 import os
 
 
@@ -20,5 +21,130 @@ if not DATABASE_URI:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool settings
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "5"))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", "10"))
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", "30"))
+DATABASE_POOL_RECYCLE = int(os.getenv("DATABASE_POOL_RECYCLE", "1800"))
+DATABASE_POOL_PRE_PING = os.getenv("DATABASE_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")
+
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_pre_ping": DATABASE_POOL_PRE_PING,
+    "pool_recycle": DATABASE_POOL_RECYCLE,
+}
+# SQLite does not use a queue pool, so only size the pool for real servers
+if not DATABASE_URI.startswith("sqlite"):
+    SQLALCHEMY_ENGINE_OPTIONS.update(
+        pool_size=DATABASE_POOL_SIZE,
+        max_overflow=DATABASE_MAX_OVERFLOW,
+        pool_timeout=DATABASE_POOL_TIMEOUT,
+    )
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Keyset pagination for GET /accounts
+ACCOUNTS_PAGE_SIZE = int(os.getenv("ACCOUNTS_PAGE_SIZE", "100"))
+ACCOUNTS_MAX_PAGE_SIZE = int(os.getenv("ACCOUNTS_MAX_PAGE_SIZE", "1000"))
+
+# Number of rows fetched per round trip when streaming accounts
+ACCOUNTS_STREAM_BATCH_SIZE = int(os.getenv("ACCOUNTS_STREAM_BATCH_SIZE", "1000"))
+
+# Number of rows inserted per transaction by POST /accounts/bulk
+ACCOUNTS_BULK_BATCH_SIZE = int(os.getenv("ACCOUNTS_BULK_BATCH_SIZE", "500"))
+
+# Worker processes serving the app; gunicorn.conf.py sets it for the workers
+WORKERS = int(os.getenv("GUNICORN_WORKERS", "1"))
+
+# Cache shared by every worker process, e.g. redis://localhost:6379/0; the
+# Account cache and the idempotency keys are kept per process without it
+CACHE_BACKEND_URL = os.getenv("CACHE_BACKEND_URL", "")
+
+# Read-through cache for single Account lookups (size 0 disables it); off by
+# default without CACHE_BACKEND_URL, since a write can only invalidate the
+# copies of the worker that served it
+ACCOUNTS_CACHE_SIZE = int(os.getenv("ACCOUNTS_CACHE_SIZE", "1024" if CACHE_BACKEND_URL else "0"))
+ACCOUNTS_CACHE_TTL = float(os.getenv("ACCOUNTS_CACHE_TTL", "30"))
+
+# Merge identical Account lookups that run at the same time in one process
+# into a single query whose result every caller shares
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "true").lower() in ("true", "1", "yes")
+
+# JSON encoder for responses: "orjson", "stdlib" or "auto" (orjson when installed)
+JSON_PROVIDER = os.getenv("JSON_PROVIDER", "auto")
+
+# Serving mode: "wsgi" runs service:app, "asgi" runs the async service.asgi:app,
+# which serves the hot reads itself and forwards every other route to Flask
+SERVER_MODE = os.getenv("SERVER_MODE", "wsgi")
+
+# The ASGI app needs an async driver: asyncpg for PostgreSQL, aiosqlite for SQLite
+ASYNC_DATABASE_URI = os.getenv("ASYNC_DATABASE_URI")
+if not ASYNC_DATABASE_URI:
+    ASYNC_DATABASE_URI = DATABASE_URI.replace(
+        "postgresql://", "postgresql+asyncpg://", 1
+    ).replace("sqlite://", "sqlite+aiosqlite://", 1)
+
+# Per-request database instrumentation: a Server-Timing header on every
+# response, a warning for queries slower than SLOW_QUERY_MS and a warning when
+# one request runs the same statement N_PLUS_ONE_THRESHOLD times (0 disables)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() in ("true", "1", "yes")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+
+# Directory shared by the gunicorn workers so that /metrics adds up the
+# samples of every worker (unset: each scrape sees only one worker). Each
+# worker writes its samples there every METRICS_WRITE_INTERVAL seconds
+METRICS_DIR = os.getenv("METRICS_DIR") or None
+METRICS_WRITE_INTERVAL = float(os.getenv("METRICS_WRITE_INTERVAL", "1"))
+
+# Response compression for clients that accept br (when Brotli is installed)
+# or gzip, for responses of these types that are at least COMPRESS_MIN_SIZE bytes
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_MIMETYPES = [
+    "application/json",
+    "application/javascript",
+    "text/css",
+    "text/csv",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+]
+
+# Seconds browsers may cache static files such as index.html before
+# revalidating them with If-Modified-Since
+SEND_FILE_MAX_AGE_DEFAULT = int(os.getenv("STATIC_MAX_AGE", "300"))
+
+# Token-bucket rate limits per client (X-API-Key header or address) and route.
+# RATE_LIMIT_PER_SECOND 0 turns the default limit off. RATE_LIMIT_ROUTES is a
+# JSON object of "METHOD /rule": [per second, burst] that applies regardless,
+# e.g. {"GET /accounts/export": [0.2, 2]}
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_ROUTES = json.loads(os.getenv("RATE_LIMIT_ROUTES", "{}"))
+RATE_LIMIT_EXEMPT = ["/health", "/metrics"]
+
+# Requests served at once by each process before new ones are shed with 503;
+# by default the number of connections the database pool can hand out
+MAX_CONCURRENT_REQUESTS = int(
+    os.getenv("MAX_CONCURRENT_REQUESTS", str(DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW))
+)
+LOAD_SHED_RETRY_AFTER = int(os.getenv("LOAD_SHED_RETRY_AFTER", "1"))
+
+# Responses remembered for POST requests sent with an Idempotency-Key header
+# (size 0 disables it), and how long a retry waits for the request it repeats.
+# Bodies over IDEMPOTENCY_MAX_BODY bytes are not kept, which bounds the store
+# to IDEMPOTENCY_KEYS_SIZE x IDEMPOTENCY_MAX_BODY bytes
+IDEMPOTENCY_KEYS_SIZE = int(os.getenv("IDEMPOTENCY_KEYS_SIZE", "10000"))
+IDEMPOTENCY_KEYS_TTL = float(os.getenv("IDEMPOTENCY_KEYS_TTL", "86400"))
+IDEMPOTENCY_KEYS_WAIT = float(os.getenv("IDEMPOTENCY_KEYS_WAIT", "30"))
+IDEMPOTENCY_MAX_BODY = int(os.getenv("IDEMPOTENCY_MAX_BODY", "65536"))
+
+# Read replicas for GET and HEAD requests, as a comma separated list of URIs.
+# Replicas are checked every REPLICA_CHECK_INTERVAL seconds and skipped while
+# they are unreachable or more than REPLICA_MAX_LAG seconds behind (0 ignores
+# lag); clients read from the primary for READ_YOUR_WRITES_SECONDS after a write
+DATABASE_REPLICA_URIS = [uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri]
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "10"))
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
@@ -3,31 +3,62 @@ Models for Account
 
 All of the models are stored in this module
 """
+import hashlib
+import io
+import json
 import logging
+import operator
+import re
 from datetime import date
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm.util import identity_key
+from service.common.cache import RecordCache, make_backend
+from service.common.replicas import RoutingSQLAlchemy, current_replica, reads_own_writes
+from service.common.single_flight import SingleFlight
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
+def init_app(app):
+    """Register the SQLAlchemy app without connecting to the database"""
+    Account.init_app(app)
+
+
 def init_db(app):
-    """Initialize the SQLAlchemy app"""
+    """Initialize the SQLAlchemy app and create the tables"""
     Account.init_db(app)
 
 
+def _copy_value(value):
+    """Formats a value for the text format of PostgreSQL COPY"""
+    if value is None:
+        return "\\N"
+    return (
+        str(value).replace("\\", "\\\\").replace("\t", "\\t")
+        .replace("\n", "\\n").replace("\r", "\\r")
+    )
+
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
 class PersistentBase:
     """Base class added persistent methods"""
 
+    cache = None  # read-through cache used by find(), set up in init_db()
+    lookups = None  # merges concurrent find() and all() calls, set up in init_db()
+    SORTABLE_FIELDS = frozenset(["id"])
+    MAX_ID = 2**31 - 1  # the largest value of the Integer id column
+
     def __init__(self):
         self.id = None  # pylint: disable=invalid-name
 
@@ -38,42 +69,494 @@ class PersistentBase:
         logger.info("Creating %s", self.name)
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
-        db.session.commit()
+        self._commit_without_expiry()
 
     def update(self):
         """
         Updates a Account to the database
         """
         logger.info("Updating %s", self.name)
-        db.session.commit()
+        if getattr(self, "_from_cache", False):
+            # the cached values may be stale, so write every column instead
+            # of only those that differ from them
+            for column in self.__table__.columns:
+                if not column.primary_key:
+                    flag_modified(self, column.key)
+            self._from_cache = False
+        self._commit_without_expiry()
+        self.invalidate(self.id)
+
+    @staticmethod
+    def _commit_without_expiry():
+        """
+        Commits the session but keeps the attribute values of loaded records
+
+        The INSERT or UPDATE just wrote those values (and the INSERT fetched
+        the new primary key), so serializing the record afterwards does not
+        need the SELECT that an expired record would issue.
+        """
+        session = db.session()
+        expire_on_commit = session.expire_on_commit
+        session.expire_on_commit = False
+        try:
+            session.commit()
+        finally:
+            session.expire_on_commit = expire_on_commit
 
     def delete(self):
         """Removes a Account from the data store"""
         logger.info("Deleting %s", self.name)
+        by_id = self.id
         db.session.delete(self)
         db.session.commit()
+        self.invalidate(by_id)
 
     @classmethod
-    def init_db(cls, app):
-        """Initializes the database session"""
-        logger.info("Initializing database")
+    def create_many(cls, records):
+        """
+        Creates a batch of records in a single transaction
+
+        If the batch cannot be committed, each record is retried on its own
+        so that one bad record does not fail the rest of the batch.
+
+        Returns:
+            list: an (id, error) tuple for every record, in the same order,
+                where error is the SQLAlchemyError that failed the record
+        """
+        logger.info("Creating a batch of %s records", len(records))
+        for record in records:
+            record.id = None  # id must be none to generate next primary key
+        try:
+            db.session.add_all(records)
+            db.session.flush()
+            # read the ids before commit() expires them
+            results = [(record.id, None) for record in records]
+            db.session.commit()
+            return results
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            logger.warning("Batch insert failed, retrying one at a time: %s", error)
+
+        results = []
+        for record in records:
+            record.id = None
+            try:
+                db.session.add(record)
+                db.session.flush()
+                new_id = record.id
+                db.session.commit()
+                results.append((new_id, None))
+            except SQLAlchemyError as error:
+                db.session.rollback()
+                results.append((None, error))
+        return results
+
+    @classmethod
+    def load_many(cls, rows):
+        """
+        Inserts a batch of column dictionaries as fast as the database allows
+
+        PostgreSQL loads the batch with COPY FROM STDIN, other databases
+        with a single executemany INSERT. The rows are not validated and
+        their ids are not returned.
+
+        Returns:
+            int: the number of rows that were inserted
+        """
+        columns = [column.key for column in cls.__table__.columns if not column.primary_key]
+        connection = db.session.connection()
+        if connection.dialect.name == "postgresql":
+            buffer = io.StringIO()
+            for row in rows:
+                buffer.write("\t".join(_copy_value(row.get(column)) for column in columns) + "\n")
+            buffer.seek(0)
+            sql = f"COPY {cls.__tablename__} ({', '.join(columns)}) FROM STDIN"
+            dbapi_error = connection.dialect.dbapi.Error
+            try:
+                with connection.connection.cursor() as cursor:
+                    cursor.copy_expert(sql, buffer)
+            except dbapi_error as error:
+                # raise it like SQLAlchemy would for any other statement
+                raise DBAPIError.instance(sql, None, error, dbapi_error) from error
+        else:
+            connection.execute(
+                cls.__table__.insert(),
+                [{column: row.get(column) for column in columns} for row in rows],
+            )
+        db.session.commit()
+        return len(rows)
+
+    @classmethod
+    def update_by_id(cls, by_id, values):
+        """
+        Updates one record in place without reading it first
+
+        Args:
+            by_id (int): the id of the record to update
+            values (dict): the new column values
+
+        Returns:
+            the updated record, detached from the session, or None if
+            there is no record with that id
+        """
+        logger.info("Updating id %s in place", by_id)
+        table = cls.__table__
+        statement = db.update(table).where(table.c.id == by_id).values(**values)
+        if db.engine.dialect.full_returning:
+            row = db.session.execute(statement.returning(*table.columns)).first()
+        else:
+            row = None
+            if db.session.execute(statement).rowcount:
+                row = db.session.execute(db.select(table).where(table.c.id == by_id)).first()
+        db.session.commit()
+        cls.invalidate(by_id)
+        return cls(**row._asdict()) if row else None
+
+    @classmethod
+    def update_many(cls, criteria, values):
+        """
+        Updates every record that matches the criteria with one UPDATE
+
+        Args:
+            criteria (list): SQL criteria that select the records
+            values (dict): the new column values
+
+        Returns:
+            int: the number of records that were updated
+        """
+        logger.info("Updating %s in bulk", cls.__name__)
+        statement = db.update(cls.__table__).values(**values)
+        return cls._execute_many(statement, criteria)
+
+    @classmethod
+    def delete_many(cls, criteria):
+        """
+        Deletes every record that matches the criteria with one DELETE
+
+        Args:
+            criteria (list): SQL criteria that select the records
+
+        Returns:
+            int: the number of records that were deleted
+        """
+        logger.info("Deleting %s in bulk", cls.__name__)
+        return cls._execute_many(db.delete(cls.__table__), criteria)
+
+    @classmethod
+    def _execute_many(cls, statement, criteria):
+        """Runs a set-based UPDATE or DELETE and invalidates the affected records"""
+        id_column = cls.__table__.c.id
+        statement = statement.where(*criteria)
+        if db.engine.dialect.full_returning:
+            ids = [row[0] for row in db.session.execute(statement.returning(id_column))]
+            count = len(ids)
+        else:
+            # without RETURNING, lock the matching ids so they can be invalidated
+            ids = [row[0] for row in db.session.query(cls.id).filter(*criteria).with_for_update()]
+            count = db.session.execute(statement).rowcount
+        db.session.commit()
+        for by_id in ids:
+            cls.invalidate(by_id)
+        return count
+
+    @classmethod
+    def init_app(cls, app):
+        """
+        Registers the database with the app
+
+        Nothing connects here: the engine and its pool are created on the
+        first request that uses the database.
+        """
         cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
+        if "sqlalchemy" not in app.extensions:
+            db.init_app(app)
+        cls.init_cache(app)
+        cls.lookups = SingleFlight(cls.__tablename__) if app.config.get("SINGLE_FLIGHT", True) else None
+
+    @classmethod
+    def init_db(cls, app):
+        """Initializes the database session and creates the tables"""
+        logger.info("Initializing database")
+        cls.init_app(app)
         app.app_context().push()
         db.create_all()  # make our sqlalchemy tables
 
+    @classmethod
+    def create_indexes(cls):
+        """Creates any indexes missing from a table made by an older release"""
+        for index in cls.__table__.indexes:
+            logger.info("Creating index %s if it does not exist", index.name)
+            try:
+                index.create(db.engine, checkfirst=True)
+            except DBAPIError as error:
+                # some dialects cannot reflect expression indexes for checkfirst
+                if "already exists" not in str(error.orig):
+                    raise
+
+    @classmethod
+    def init_cache(cls, app, backend=None):
+        """Sets up the read-through cache used by find()"""
+        size = app.config.get("ACCOUNTS_CACHE_SIZE", 0)
+        if size > 0:
+            if backend is None:
+                backend = make_backend(app.config.get("CACHE_BACKEND_URL"))
+            if backend is None and app.config.get("WORKERS", 1) > 1:
+                logger.warning(
+                    "The %s cache is kept per process with %d workers: a write on one worker "
+                    "leaves the others serving stale rows until ACCOUNTS_CACHE_TTL", cls.__tablename__,
+                    app.config["WORKERS"],
+                )
+            ttl = app.config.get("ACCOUNTS_CACHE_TTL", 30)
+            cls.cache = RecordCache(maxsize=size, ttl=ttl, backend=backend)
+        else:
+            cls.cache = None
+
+    @classmethod
+    def invalidate(cls, by_id):
+        """Removes a record from the read-through cache"""
+        if cls.cache is not None:
+            cls.cache.delete(cls._cache_key(by_id))
+
+    @classmethod
+    def _cache_key(cls, by_id):
+        """Returns the cache key of the record with the given id"""
+        return f"{cls.__tablename__}:{by_id}"
+
+    @classmethod
+    def _column_values(cls, record):
+        """Returns the column values of a record as a dictionary"""
+        return {column.key: getattr(record, column.key) for column in cls.__table__.columns}
+
+    @classmethod
+    def _attach(cls, values):
+        """Adds a record built from column values to the session without a SELECT"""
+        record = cls(**values)
+        make_transient_to_detached(record)
+        return db.session.merge(record, load=False)
+
+    @classmethod
+    def _load_once(cls, key, load):
+        """
+        Runs load() once for identical lookups that are in flight together
+
+        The caller that runs the query gets its own records back; the callers
+        that waited for it get copies built from the shared column values and
+        attached to their own session, since records cannot move between
+        sessions. A session with pending changes, or a client that must read
+        its own recent writes, always runs its own query.
+
+        Args:
+            key (str): identifies the lookup, e.g. "find:1"
+            load (callable): returns a record, a list of records or None
+        """
+        session = db.session
+        if cls.lookups is None or session.new or session.dirty or session.deleted or reads_own_writes():
+            return load()
+
+        def load_values():
+            result = load()
+            if result is None:
+                return result, None
+            if isinstance(result, list):
+                return result, [cls._column_values(record) for record in result]
+            return result, cls._column_values(result)
+
+        # reads from different databases are never merged
+        (result, values), shared = cls.lookups.do((key, id(current_replica())), load_values)
+        if not shared or values is None:
+            return result
+        if isinstance(values, list):
+            return [cls._attach(value) for value in values]
+        return cls._attach(values)
+
     @classmethod
     def all(cls):
         """Returns all of the records in the database"""
         logger.info("Processing all records")
-        return cls.query.all()
+        return cls._load_once("all", cls.query.all)
+
+    @classmethod
+    def as_rows(cls, query=None, fields=None):
+        """Returns a query for plain column tuples instead of records
+
+        Rows skip ORM object hydration and identity map bookkeeping, which
+        makes them much cheaper for endpoints that only serialize the data.
+        Use row._asdict() to get a dictionary keyed by column name.
+
+        Args:
+            query (Query): an optional filtered query to select rows from
+            fields (list): the names of the columns to select, all by default
+        """
+        columns = cls.__table__.columns
+        if fields is not None:
+            unknown = [field for field in fields if field not in columns]
+            if unknown:
+                raise DataValidationError("Invalid fields: " + ", ".join(unknown))
+            columns = [columns[field] for field in fields]
+        return (cls.query if query is None else query).with_entities(*columns)
+
+    @classmethod
+    def sort_key(cls, sort=None):
+        """
+        Parses a sort parameter such as "name" or "-date_joined"
+
+        Returns:
+            tuple: the column to sort on and True for a descending sort
+        """
+        sort = sort or "id"
+        descending = sort.startswith("-")
+        field = sort[1:] if descending else sort
+        if field not in cls.SORTABLE_FIELDS:
+            raise DataValidationError(
+                f"Invalid sort [{sort}], must be one of " + ", ".join(sorted(cls.SORTABLE_FIELDS))
+            )
+        return cls.__table__.columns[field], descending
+
+    @classmethod
+    def find_page(cls, after_id=None, limit=None, query=None, sort=None, after=None):
+        """Returns one page of records in sort order, then by id
+
+        Uses keyset pagination so the database seeks straight to the last
+        row of the previous page instead of scanning past an OFFSET. NULLs
+        sort as the largest value: last ascending and first descending.
+
+        Args:
+            after_id (int): the id of the last record of the previous page
+            limit (int): the maximum number of records to return
+            query (Query): an optional filtered query to page through
+            sort (string): the field to sort on, prefixed with - to reverse it
+            after (string): the sort field value of the last record of the
+                previous page; it is looked up from after_id when missing
+        """
+        logger.info("Processing page after id %s (limit %s, sort %s)", after_id, limit, sort)
+        column, descending = cls.sort_key(sort)
+        id_column = cls.__table__.c.id
+        if column.nullable:
+            order = [column.desc().nulls_first() if descending else column.asc().nulls_last()]
+        else:
+            order = [column.desc() if descending else column]
+        if column is not id_column:
+            order.append(id_column.desc() if descending else id_column)
+        query = (cls.query if query is None else query).order_by(*order)
+        if after_id is not None:
+            query = query.filter(cls._after_criteria(column, descending, after_id, after))
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    @classmethod
+    def _after_criteria(cls, column, descending, after_id, after):
+        """Returns the keyset criteria for the rows after (after, after_id)"""
+        id_column = cls.__table__.c.id
+        beyond = operator.lt if descending else operator.gt
+        if column is id_column:
+            return beyond(id_column, after_id)
+        if after is None:
+            # a page that ended on a NULL has no after value in its next link
+            after = db.select(column).where(id_column == after_id).scalar_subquery()
+            after_is_null = after.is_(None)
+        else:
+            after = cls._parse_value(column, after)
+            after_is_null = db.false()
+        criteria = db.or_(beyond(column, after), db.and_(column == after, beyond(id_column, after_id)))
+        if not column.nullable:
+            return criteria
+        if descending:
+            # the NULLs came first: after a NULL every non-NULL row follows
+            return db.or_(
+                criteria, db.and_(after_is_null, db.or_(column.isnot(None), beyond(id_column, after_id)))
+            )
+        # the NULLs come last: after a value all of them follow, after a NULL the later ids
+        return db.or_(
+            criteria, db.and_(column.is_(None), db.or_(db.not_(after_is_null), beyond(id_column, after_id)))
+        )
+
+    @staticmethod
+    def _parse_value(column, value):
+        """Converts a query string value to the Python type of column"""
+        try:
+            if column.type.python_type is date:
+                return date.fromisoformat(value)
+            return column.type.python_type(value)
+        except ValueError as error:
+            raise DataValidationError(f"Invalid value [{value}] for {column.key}") from error
+
+    @classmethod
+    def stream(cls, after_id=None, batch_size=1000, query=None):
+        """Yields all records ordered by id, fetching them in batches
+
+        Args:
+            after_id (int): only return records with an id greater than this
+            batch_size (int): the number of rows to fetch per round trip
+            query (Query): an optional filtered query to stream
+        """
+        logger.info("Streaming records after id %s", after_id)
+        query = (cls.query if query is None else query).order_by(cls.id)
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        return query.yield_per(batch_size)
+
+    @classmethod
+    def find_many(cls, ids, query=None, chunk_size=500):
+        """Returns the records with the given ids in the order of ids
+
+        Runs one WHERE id IN (...) query per chunk_size ids instead of one
+        query per id. Ids that match no record are left out; repeated ids
+        return the record once.
+
+        Args:
+            ids (list): the ids of the records to return
+            query (Query): an optional query to select from, e.g. as_rows()
+            chunk_size (int): the most ids bound to a single query
+        """
+        ids = list(dict.fromkeys(ids))
+        logger.info("Processing lookup for %s ids ...", len(ids))
+        query = cls.query if query is None else query
+        by_id = {}
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            by_id.update((record.id, record) for record in query.filter(cls.id.in_(chunk)))
+        return [by_id[record_id] for record_id in ids if record_id in by_id]
+
+    @classmethod
+    def find_for_update(cls, by_id):
+        """Finds a record by it's ID and locks the row until the next commit"""
+        logger.info("Processing locked lookup for id %s ...", by_id)
+        return (
+            cls.query.filter(cls.id == by_id)
+            .with_for_update()
+            .populate_existing()
+            .first()
+        )
 
     @classmethod
     def find(cls, by_id):
         """Finds a record by it's ID"""
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        # objects already in this session are returned without a query
+        record = db.session.identity_map.get(identity_key(cls, by_id))
+        if record is not None:
+            return record
+        if cls.cache is None or reads_own_writes():
+            return cls._load_once(f"find:{by_id}", lambda: cls.query.get(by_id))
+
+        key = cls._cache_key(by_id)
+        values = cls.cache.get(key)
+        if values is not None:
+            # attach the cached row to the session without a SELECT
+            record = cls._attach(values)
+            record._from_cache = True  # pylint: disable=protected-access
+            return record
+
+        # a lookup that began before the record was invalidated is not cached,
+        # and lookups are only merged with one that began in the same generation
+        generation = cls.cache.generation(key)
+        record = cls._load_once(f"find:{by_id}:{generation}", lambda: cls.query.get(by_id))
+        # rows read from a replica may lag the primary, so they are not cached
+        if record is not None and current_replica() is None:
+            cls.cache.set(key, cls._column_values(record), generation)
+        return record
 
 
 ######################################################################
@@ -86,14 +569,29 @@ class Account(db.Model, PersistentBase):
 
     app = None
 
+    # Fields a partial update may change, and those it may not set to null
+    NON_NULL_FIELDS = frozenset(["name", "email", "address", "date_joined"])
+    CHANGEABLE_FIELDS = NON_NULL_FIELDS | {"phone_number"}
+    SORTABLE_FIELDS = frozenset(["id", "name", "email", "date_joined"])
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(64))
+    name = db.Column(db.String(64), index=True)
     email = db.Column(db.String(64))
     address = db.Column(db.String(256))
     phone_number = db.Column(db.String(32), nullable=True)  # phone number is optional
     date_joined = db.Column(db.Date(), nullable=False, default=date.today())
 
+    __table_args__ = (
+        # text_pattern_ops lets PostgreSQL use the index for LIKE 'prefix%'
+        db.Index(
+            "ix_account_name_lower",
+            db.func.lower(name).label("name_lower"),
+            postgresql_ops={"name_lower": "text_pattern_ops"},
+        ),
+        db.Index("ix_account_email_lower", db.func.lower(email), unique=True),
+    )
+
     def __repr__(self):
         return f"<Account {self.name} id=[{self.id}]>"
 
@@ -108,6 +606,11 @@ class Account(db.Model, PersistentBase):
             "date_joined": self.date_joined.isoformat()
         }
 
+    def etag(self):
+        """Returns a strong entity tag computed from the serialized Account"""
+        data = json.dumps(self.serialize(), sort_keys=True).encode("utf8")
+        return hashlib.sha1(data).hexdigest()
+
     def deserialize(self, data):
         """
         Deserializes a Account from a dictionary
@@ -139,6 +642,37 @@ class Account(db.Model, PersistentBase):
             ) from error
         return self
 
+    @classmethod
+    def deserialize_changes(cls, data):
+        """
+        Validates a partial update of an Account
+
+        Args:
+            data (dict): the fields to change and their new values
+
+        Returns:
+            dict: the new column values
+        """
+        if not isinstance(data, dict) or not data:
+            raise DataValidationError("Invalid Account: changes must be a non-empty object")
+        unknown = set(data) - cls.CHANGEABLE_FIELDS
+        if unknown:
+            raise DataValidationError(
+                "Invalid Account: cannot change " + ", ".join(sorted(unknown))
+            )
+        changes = dict(data)
+        for field in cls.NON_NULL_FIELDS & set(changes):
+            if changes[field] is None:
+                raise DataValidationError(f"Invalid Account: {field} cannot be null")
+        if "date_joined" in changes:
+            try:
+                changes["date_joined"] = date.fromisoformat(changes["date_joined"])
+            except (TypeError, ValueError) as error:
+                raise DataValidationError(
+                    "Invalid Account: invalid date format - " + str(error)
+                ) from error
+        return changes
+
     @classmethod
     def find_by_name(cls, name):
         """Returns all Accounts with the given name
@@ -148,3 +682,45 @@ class Account(db.Model, PersistentBase):
         """
         logger.info("Processing name query for %s ...", name)
         return cls.query.filter(cls.name == name)
+
+    @classmethod
+    def find_by_email(cls, email):
+        """Returns the Account with the given email, ignoring case
+
+        Args:
+            email (string): the email of the Account you want to match
+        """
+        logger.info("Processing email query for %s ...", email)
+        return cls.query.filter(db.func.lower(cls.email) == email.lower())
+
+    @classmethod
+    def search(cls, name=None, name_prefix=None, email=None, joined_after=None, joined_before=None):
+        """Returns a query for the Accounts that match every given filter
+
+        Args:
+            name (string): the exact name to match
+            name_prefix (string): the start of the name to match, ignoring case
+            email (string): the email to match, ignoring case
+            joined_after (date): only Accounts that joined after this day
+            joined_before (date): only Accounts that joined before this day
+        """
+        return cls.query.filter(
+            *cls.search_criteria(name, name_prefix, email, joined_after, joined_before)
+        )
+
+    @classmethod
+    def search_criteria(cls, name=None, name_prefix=None, email=None, joined_after=None, joined_before=None):
+        """Returns the SQL criteria used by search() as a list"""
+        criteria = []
+        if joined_after is not None:
+            criteria.append(cls.date_joined > joined_after)
+        if joined_before is not None:
+            criteria.append(cls.date_joined < joined_before)
+        if name is not None:
+            criteria.append(cls.name == name)
+        if name_prefix is not None:
+            pattern = re.sub(r"([\\%_])", r"\\\1", name_prefix.lower()) + "%"
+            criteria.append(db.func.lower(cls.name).like(pattern, escape="\\"))
+        if email is not None:
+            criteria.append(db.func.lower(cls.email) == email.lower())
+        return criteria
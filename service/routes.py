@@ -6,38 +6,87 @@ Account Service
 This microservice handles the lifecycle of Accounts
 """
 # pylint: disable=unused-import
-from flask import jsonify, request, make_response, abort, send_from_directory   # noqa; F401
-from service.models import Account
-from service.common import status  # HTTP Status Codes
-from . import app  # Import Flask application
+import io
+from datetime import date
+from flask import json, jsonify, request, make_response, abort, send_from_directory   # noqa; F401
+from flask import Blueprint, Response, current_app as app, stream_with_context, url_for
+from sqlalchemy.exc import DataError, IntegrityError
+from service.models import db, Account, DataValidationError
+from service.common import export, status  # HTTP Status Codes
+from service.common.idempotency import idempotent
+from service.common.pool_metrics import pool_metrics
+from service.common.metrics import registry
+
+# Registered on the Flask application by create_app()
+api = Blueprint("accounts", __name__)
 
 
 ############################################################
 # Health Endpoint
 ############################################################
-@app.route("/health")
+@api.route("/health")
 def health():
     """Health Status"""
     return jsonify(dict(status="OK")), status.HTTP_200_OK
 
 
+############################################################
+# Internal Statistics Endpoint
+############################################################
+@api.route("/stats")
+def stats():
+    """Internal counters for operators"""
+    cache_stats = Account.cache.stats() if Account.cache else None
+    return (
+        jsonify(
+            cache=cache_stats,
+            pool=pool_metrics.stats(db.engine),
+            replicas=app.extensions["replicas"].stats(),
+        ),
+        status.HTTP_200_OK,
+    )
+
+
+############################################################
+# Metrics Endpoint
+############################################################
+@api.route("/metrics")
+def metrics():
+    """
+    Request, latency and database metrics in the Prometheus text format
+
+    Every gunicorn worker keeps its own samples. With METRICS_DIR set the
+    response adds up the samples of all workers (those of other workers
+    are up to METRICS_WRITE_INTERVAL seconds old); without it a scrape
+    only sees the worker that answered, so counters appear to jump and
+    reset between scrapes when there is more than one worker.
+    """
+    return Response(
+        registry.expose(app.config.get("METRICS_DIR")),
+        status.HTTP_200_OK,
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route("/")
+@api.route("/")
 def index():
-    """Root URL response"""
+    """Root URL response, cached for SEND_FILE_MAX_AGE_DEFAULT seconds"""
     return send_from_directory(app.static_folder, 'index.html')
 
 
 ######################################################################
 # CREATE A NEW ACCOUNT
 ######################################################################
-@app.route("/accounts", methods=["POST"])
+@api.route("/accounts", methods=["POST"])
+@idempotent
 def create_accounts():
     """
     Creates an Account
-    This endpoint will create an Account based on the data in the body that is posted
+    This endpoint will create an Account based on the data in the body that is posted.
+    Retries sent with the same `Idempotency-Key` header get the first response back.
     """
     app.logger.info("Request to create an Account")
     check_content_type("application/json")
@@ -53,30 +102,344 @@ def create_accounts():
     )
 
 
+######################################################################
+# CREATE ACCOUNTS IN BULK
+######################################################################
+@api.route("/accounts/bulk", methods=["POST"])
+@idempotent
+def create_accounts_bulk():
+    """
+    Creates Accounts in bulk
+    This endpoint accepts a JSON array or NDJSON body of Accounts and inserts
+    them in batches of `batch_size` rows per transaction. Every row gets its
+    own result so that bad rows do not fail the rest of the request.
+    """
+    app.logger.info("Request to create Accounts in bulk")
+    batch_size = get_int_arg(
+        "batch_size", app.config["ACCOUNTS_BULK_BATCH_SIZE"], minimum=1
+    )
+    if request.mimetype == "application/x-ndjson":
+        rows = read_ndjson_rows()
+    else:
+        check_content_type("application/json")
+        rows = request.get_json()
+        if not isinstance(rows, list):
+            abort(status.HTTP_400_BAD_REQUEST, "Request body must be a JSON array")
+
+    results = []
+    batch = []
+    for index, row in enumerate(rows):
+        try:
+            if isinstance(row, DataValidationError):
+                raise row
+            batch.append((index, Account().deserialize(row)))
+        except DataValidationError as error:
+            results.append(
+                {"index": index, "status": status.HTTP_400_BAD_REQUEST, "error": str(error)}
+            )
+        if len(batch) >= batch_size:
+            results.extend(create_account_batch(batch))
+            batch = []
+    if batch:
+        results.extend(create_account_batch(batch))
+
+    results.sort(key=lambda result: result["index"])
+    failed = sum(1 for result in results if "error" in result)
+    app.logger.info("Created [%s] accounts, [%s] failed", len(results) - failed, failed)
+    return (
+        jsonify(created=len(results) - failed, failed=failed, results=results),
+        status.HTTP_207_MULTI_STATUS if failed else status.HTTP_201_CREATED,
+    )
+
+
+def read_ndjson_rows():
+    """Yields one parsed row per line of an NDJSON request body"""
+    lines = request.stream
+    if request.headers.get("Idempotency-Key"):
+        # the body was already read and cached to fingerprint the request
+        lines = io.BytesIO(request.get_data())
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as error:
+            yield DataValidationError(f"Invalid Account: line is not valid JSON - {error}")
+
+
+def create_account_batch(batch):
+    """Inserts a batch of (index, Account) pairs and returns their results"""
+    accounts = [account for _, account in batch]
+    results = []
+    for (index, _), (account_id, error) in zip(batch, Account.create_many(accounts)):
+        if error:
+            results.append(
+                {"index": index, "status": row_error_status(error), "error": str(getattr(error, "orig", None) or error)}
+            )
+        else:
+            results.append(
+                {"index": index, "status": status.HTTP_201_CREATED, "id": account_id}
+            )
+    return results
+
+
+def row_error_status(error):
+    """Returns the status of a row that the database refused"""
+    if isinstance(error, IntegrityError):
+        return status.HTTP_409_CONFLICT  # e.g. the email is already taken
+    if isinstance(error, DataError):
+        return status.HTTP_400_BAD_REQUEST  # e.g. a value too long for its column
+    app.logger.error("Bulk create failed for a row: %s", error)
+    return status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+######################################################################
+# UPDATE ACCOUNTS IN BULK
+######################################################################
+@api.route("/accounts", methods=["PATCH"])
+def update_accounts():
+    """
+    Updates Accounts in bulk
+    This endpoint applies the same changes to every Account selected by
+    `ids` and/or `filter` with a single UPDATE statement, e.g.
+    {"ids": [1, 2], "set": {"address": "New address"}}
+    """
+    app.logger.info("Request to update Accounts in bulk")
+    check_content_type("application/json")
+    data = get_json_object()
+    criteria = get_bulk_criteria(data)
+    changes = Account.deserialize_changes(data.get("set"))
+    count = Account.update_many(criteria, changes)
+    app.logger.info("Updated [%s] accounts", count)
+    return jsonify(updated=count), status.HTTP_200_OK
+
+
+######################################################################
+# DELETE ACCOUNTS IN BULK
+######################################################################
+@api.route("/accounts", methods=["DELETE"])
+def delete_accounts():
+    """
+    Deletes Accounts in bulk
+    This endpoint deletes every Account selected by `ids` and/or `filter`
+    with a single DELETE statement, e.g. {"filter": {"name_prefix": "test-"}}
+    """
+    app.logger.info("Request to delete Accounts in bulk")
+    check_content_type("application/json")
+    count = Account.delete_many(get_bulk_criteria(get_json_object()))
+    app.logger.info("Deleted [%s] accounts", count)
+    return jsonify(deleted=count), status.HTTP_200_OK
+
+
 ######################################################################
 # LIST ALL ACCOUNTS
 ######################################################################
 
-@app.route("/accounts", methods=["GET"])
+@api.route("/accounts", methods=["GET"])
 def list_accounts():
     """
     List all Accounts
-    This endpoint will list all Accounts
+    This endpoint will list Accounts one page at a time. Pages are keyed on
+    the sort order: follow the `Link: rel="next"` header, which carries the
+    `after_id` (and for other sorts the `after` value) of the last Account,
+    to fetch the next page. Use `?stream=ndjson` or `?stream=json` to stream
+    every Account in a single response instead.
+
+    Accounts can be filtered with `?name=` (exact match), `?name_prefix=`
+    and `?email=` (both case-insensitive), and `?joined_after=` and
+    `?joined_before=` (ISO dates, exclusive). `?sort=name` sorts on a field,
+    `?sort=-name` reverses it, and `?fields=id,name` selects only the
+    listed columns from the database.
+
+    `?ids=1,2,3` looks up the listed Accounts with a single query instead
+    and returns {"accounts": [...], "missing": [...]}, with the Accounts in
+    the order of `ids` and the ids that were not found.
     """
     app.logger.info("Request to list Accounts")
+    after_id = get_int_arg("after_id")
+    query = search_accounts()
+    fields = get_list_arg("fields")
+
+    ids = get_list_arg("ids")
+    if ids is not None:
+        return find_accounts(ids, query, fields)
+
+    stream = request.args.get("stream")
+    if stream:
+        return stream_accounts(stream, after_id, query, fields)
+
+    limit = get_int_arg("limit", app.config["ACCOUNTS_PAGE_SIZE"], minimum=1)
+    limit = min(limit, app.config["ACCOUNTS_MAX_PAGE_SIZE"])
+    sort = request.args.get("sort")
+    sort_field = Account.sort_key(sort)[0].key
+
+    # the id and sort field are always selected to build the next page link
+    selected = None if fields is None else list(dict.fromkeys(["id", sort_field, *fields]))
+    # fetch one extra row to find out if there is a next page; plain rows
+    # skip ORM hydration and their dates are encoded by the JSON provider
+    rows = Account.find_page(
+        after_id, limit + 1, Account.as_rows(query, selected), sort, request.args.get("after")
+    )
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    if fields is None:
+        account_list = [row._asdict() for row in rows]
+    else:
+        account_list = [{field: getattr(row, field) for field in fields} for row in rows]
 
-    accounts = Account.all()
-    account_list = [account.serialize() for account in accounts]
+    headers = {}
+    if has_next:
+        headers["Link"] = f'<{next_page_url(rows[-1], sort_field, limit)}>; rel="next"'
 
     app.logger.info("Returning [%s] accounts", len(account_list))
-    return jsonify(account_list), status.HTTP_200_OK
+    response = make_response(jsonify(account_list), status.HTTP_200_OK, headers)
+    response.add_etag()
+    # let browsers keep the page but revalidate it with If-None-Match
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def find_accounts(ids, query, fields):
+    """Returns the Accounts with the given ids and the ids that were not found"""
+    try:
+        ids = [int(by_id) for by_id in ids]
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "Query parameter [ids] must be a list of integers")
+    if not all(1 <= by_id <= Account.MAX_ID for by_id in ids):
+        abort(status.HTTP_400_BAD_REQUEST, f"Query parameter [ids] must list ids from 1 to {Account.MAX_ID}")
+    if len(ids) > app.config["ACCOUNTS_MAX_PAGE_SIZE"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Query parameter [ids] may list at most {app.config['ACCOUNTS_MAX_PAGE_SIZE']} ids",
+        )
+    # the id is always selected to put the rows in the order of ids
+    selected = None if fields is None else list(dict.fromkeys(["id", *fields]))
+    rows = Account.find_many(ids, Account.as_rows(query, selected))
+    found = {row.id for row in rows}
+    missing = [by_id for by_id in dict.fromkeys(ids) if by_id not in found]
+    if fields is None:
+        account_list = [row._asdict() for row in rows]
+    else:
+        account_list = [{field: getattr(row, field) for field in fields} for row in rows]
+
+    app.logger.info("Returning [%s] accounts, [%s] not found", len(account_list), len(missing))
+    response = make_response(jsonify(accounts=account_list, missing=missing), status.HTTP_200_OK)
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def next_page_url(last_row, sort_field, limit):
+    """Returns the URL of the page after last_row with the same parameters"""
+    args = request.args.to_dict()
+    args.update(after_id=last_row.id, limit=limit)
+    args.pop("after", None)
+    # without an after value the page after a NULL is found from after_id
+    value = getattr(last_row, sort_field)
+    if sort_field != "id" and value is not None:
+        args["after"] = str(value)
+    return url_for(".list_accounts", **args)
+
+
+def search_accounts():
+    """Returns a query for the Accounts that match the filters of the request"""
+    return Account.search(
+        name=request.args.get("name"),
+        name_prefix=request.args.get("name_prefix"),
+        email=request.args.get("email"),
+        joined_after=get_date_arg("joined_after"),
+        joined_before=get_date_arg("joined_before"),
+    )
+
+
+def stream_accounts(stream, after_id=None, query=None, fields=None):
+    """Streams every Account as NDJSON or as a chunked JSON array, in id order"""
+    if stream not in ("ndjson", "json"):
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Invalid stream format [{stream}], must be ndjson or json",
+        )
+    rows = Account.stream(
+        after_id, app.config["ACCOUNTS_STREAM_BATCH_SIZE"], Account.as_rows(query, fields)
+    )
+
+    def generate_ndjson():
+        for row in rows:
+            yield json.dumps(row._asdict()) + "\n"
+
+    def generate_json():
+        separator = "["
+        for row in rows:
+            yield separator + json.dumps(row._asdict())
+            separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    if stream == "ndjson":
+        return Response(
+            stream_with_context(generate_ndjson()),
+            status.HTTP_200_OK,
+            mimetype="application/x-ndjson",
+        )
+    return Response(
+        stream_with_context(generate_json()),
+        status.HTTP_200_OK,
+        mimetype="application/json",
+    )
+
+
+######################################################################
+# EXPORT ALL ACCOUNTS
+######################################################################
+EXPORT_MIMETYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+@api.route("/accounts/export", methods=["GET"])
+def export_accounts():
+    """
+    Export Accounts
+    This endpoint streams every Account as `?format=csv` (the default) or
+    `?format=ndjson` from a server-side cursor, so memory use stays flat no
+    matter how many Accounts there are. Clients that accept gzip get the
+    export compressed on the fly. The GET /accounts filters also apply.
+    """
+    app.logger.info("Request to export Accounts")
+    export_format = request.args.get("format", "csv")
+    if export_format not in EXPORT_MIMETYPES:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Invalid export format [{export_format}], must be csv or ndjson",
+        )
+    query = search_accounts()
+    rows = Account.stream(
+        batch_size=app.config["ACCOUNTS_STREAM_BATCH_SIZE"], query=Account.as_rows(query)
+    )
+    if export_format == "csv":
+        columns = [column.key for column in Account.__table__.columns]
+        chunks = export.chunked(export.csv_lines(columns, rows))
+    else:
+        chunks = export.chunked(export.ndjson_lines(row._asdict() for row in rows))
+
+    headers = {
+        "Content-Disposition": f'attachment; filename="accounts.{export_format}"',
+        "Vary": "Accept-Encoding",
+    }
+    if request.accept_encodings["gzip"]:
+        chunks = export.gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(
+        stream_with_context(chunks),
+        status.HTTP_200_OK,
+        headers,
+        mimetype=EXPORT_MIMETYPES[export_format],
+    )
 
 
 ######################################################################
 # READ AN ACCOUNT
 ######################################################################
 
-@app.route("/accounts/<int:account_id>", methods=["GET"])
+@api.route("/accounts/<int:account_id>", methods=["GET"])
 def get_account(account_id):
     """
     Reads an Account
@@ -86,41 +449,63 @@ def get_account(account_id):
     account = Account.find(account_id)
     if not account:
         abort(status.HTTP_404_NOT_FOUND, f"Account with id [{account_id}] could not be found.")
-    return jsonify(account.serialize()), status.HTTP_200_OK
+    return make_account_response(account).make_conditional(request)
 
 
 ######################################################################
 # UPDATE AN EXISTING ACCOUNT
 ######################################################################
-@app.route("/accounts/<int:account_id>", methods=["PUT"])
+@api.route("/accounts/<int:account_id>", methods=["PUT"])
 def update_account(account_id):
     """
     Update an Account
     This endpoint will update an Account based on the posted data
     """
     app.logger.info("Request to update an Account with id: %s", account_id)
-    account = Account.find(account_id)
-    if not account:
-        abort(status.HTTP_404_NOT_FOUND, f"Account with id [{account_id}] could not be found.")
+    account = find_account_for_write(account_id)
     account.deserialize(request.get_json())
     account.update()
-    return account.serialize(), status.HTTP_200_OK
+    return make_account_response(account)
+
+
+######################################################################
+# PARTIALLY UPDATE AN ACCOUNT
+######################################################################
+@api.route("/accounts/<int:account_id>", methods=["PATCH"])
+def patch_account(account_id):
+    """
+    Partially update an Account
+    This endpoint changes only the fields in the posted data and returns the
+    new representation. Without If-Match it is a single UPDATE statement
+    with no prior read.
+    """
+    app.logger.info("Request to patch an Account with id: %s", account_id)
+    check_content_type("application/json")
+    changes = Account.deserialize_changes(request.get_json())
+    if request.if_match:
+        account = find_account_for_write(account_id)
+        for field, value in changes.items():
+            setattr(account, field, value)
+        account.update()
+    else:
+        account = Account.update_by_id(account_id, changes)
+        if not account:
+            abort(status.HTTP_404_NOT_FOUND, f"Account with id [{account_id}] could not be found.")
+    return make_account_response(account)
 
 
 ######################################################################
 # DELETE AN ACCOUNT
 ######################################################################
 
-@app.route("/accounts/<int:account_id>", methods=["DELETE"])
+@api.route("/accounts/<int:account_id>", methods=["DELETE"])
 def delete_account(account_id):
     """
     Delete an Account
     This endpoint will delete an Account based on the account_id that is requested
     """
     app.logger.info("Request to delete an Account with id: %s", account_id)
-    account = Account.find(account_id)
-    if not account:
-        abort(status.HTTP_404_NOT_FOUND, f"Account with id [{account_id}] could not be found.")
+    account = find_account_for_write(account_id)
     account.delete()
     return "", status.HTTP_204_NO_CONTENT
 
@@ -129,6 +514,115 @@ def delete_account(account_id):
 # UTILITY FUNCTIONS
 ######################################################################
 
+def make_account_response(account, status_code=status.HTTP_200_OK):
+    """Returns a JSON response for an Account tagged with its ETag"""
+    response = make_response(jsonify(account.serialize()), status_code)
+    response.set_etag(account.etag())
+    return response
+
+
+def find_account_for_write(account_id):
+    """
+    Finds an Account that is about to be changed
+
+    The row is read from the database, never from the cache, and locked
+    until the change is committed. When the request carries an If-Match
+    header its current ETag must match, otherwise 412_PRECONDITION_FAILED
+    is returned so that concurrent clients cannot overwrite each other's
+    changes.
+    """
+    account = Account.find_for_update(account_id)
+    if not account:
+        abort(status.HTTP_404_NOT_FOUND, f"Account with id [{account_id}] could not be found.")
+    if request.if_match and not request.if_match.contains(account.etag()):
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Account with id [{account_id}] has been modified.",
+        )
+    return account
+
+
+def get_json_object():
+    """Returns the JSON object in the request body or aborts with 400_BAD_REQUEST"""
+    data = request.get_json()
+    if not isinstance(data, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be a JSON object")
+    return data
+
+
+def get_bulk_criteria(data):
+    """
+    Returns the SQL criteria that select the Accounts of a bulk request
+
+    Accounts are selected by a list of `ids`, by a `filter` with the same
+    fields as the GET /accounts query parameters, or by both. A request
+    that selects nothing is refused so it cannot change every Account.
+    """
+    ids = data.get("ids")
+    filters = data.get("filter")
+    if ids is None and not filters:
+        abort(status.HTTP_400_BAD_REQUEST, "Request must select Accounts with ids or a filter")
+
+    criteria = []
+    if ids is not None:
+        if not isinstance(ids, list) or not all(
+            isinstance(by_id, int) and not isinstance(by_id, bool) and 1 <= by_id <= Account.MAX_ID for by_id in ids
+        ):
+            abort(status.HTTP_400_BAD_REQUEST, f"ids must be a list of integers from 1 to {Account.MAX_ID}")
+        criteria.append(Account.id.in_(ids))
+    if filters:
+        if not isinstance(filters, dict) or set(filters) - {"name", "name_prefix", "email"}:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                "filter may only contain name, name_prefix and email",
+            )
+        if not all(isinstance(value, str) for value in filters.values()):
+            abort(status.HTTP_400_BAD_REQUEST, "filter values must be strings")
+        criteria.extend(Account.search_criteria(**filters))
+    return criteria
+
+
+def get_int_arg(name, default=None, minimum=0, maximum=Account.MAX_ID):
+    """Returns an integer query parameter or aborts with 400_BAD_REQUEST"""
+    value = request.args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    # the database cannot compare a value outside its integer range
+    if number is None or not minimum <= number <= maximum:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Query parameter [{name}] must be an integer from {minimum} to {maximum}",
+        )
+    return number
+
+
+def get_date_arg(name):
+    """Returns an ISO date query parameter or aborts with 400_BAD_REQUEST"""
+    value = request.args.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Query parameter [{name}] must be a date in YYYY-MM-DD format",
+        )
+    return None
+
+
+def get_list_arg(name):
+    """Returns a comma separated query parameter as a list, or None if it is empty"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return [item.strip() for item in value.split(",") if item.strip()] or None
+
+
 def check_content_type(media_type):
     """Checks that the media type is correct"""
     content_type = request.headers.get("Content-Type")
@@ -146,7 +640,7 @@ def check_content_type(media_type):
 # ERROR HANDLERS
 ######################################################################
 
-@app.errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+@api.app_errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
 def method_not_allowed(error):  # pragma: no cover
     """
     Handle Method Not Allowed Error
@@ -17,7 +17,7 @@ class AccountFactory(factory.Factory):
 
     id = factory.Sequence(lambda n: n)
     name = factory.Faker("name")
-    email = factory.Faker("email")
+    email = factory.Sequence(lambda n: f"account{n}@example.com")
     address = factory.Faker("address")
     phone_number = factory.Faker("phone_number")
     date_joined = FuzzyDate(date(2008, 1, 1))
@@ -0,0 +1,33 @@
+"""
+Test helper to put a ceiling on the SQL statements a block of code issues
+"""
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryCountMixin:
+    """Adds assertMaxQueries() to a TestCase"""
+
+    @contextmanager
+    def assertMaxQueries(self, maximum):  # pylint: disable=invalid-name
+        """
+        Fails if the block runs more than maximum SQL statements
+
+        Yields the list of statements so a test can inspect them; the
+        failure message lists every statement that ran.
+        """
+        statements = []
+
+        def record(conn, cursor, statement, *args):  # pylint: disable=unused-argument
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+        self.assertLessEqual(
+            len(statements), maximum,
+            f"{len(statements)} queries, expected at most {maximum}:\n" + "\n".join(statements),
+        )
@@ -0,0 +1,193 @@
+"""
+Test cases for the Record Cache
+"""
+from unittest import TestCase
+from unittest.mock import patch
+from service.common.cache import RecordCache, InMemoryBackend, CacheBackend, RedisBackend, make_backend
+
+
+class FakeClock:
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  R E C O R D   C A C H E   T E S T   C A S E S
+######################################################################
+class TestRecordCache(TestCase):
+    """Test Cases for RecordCache"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_get_and_set(self):
+        """It should return cached values and count hits and misses"""
+        cache = RecordCache(maxsize=2, ttl=10, clock=self.clock)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", {"id": 1})
+        self.assertEqual(cache.get("a"), {"id": 1})
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_lru_eviction(self):
+        """It should evict the least recently used entry"""
+        cache = RecordCache(maxsize=2, ttl=10, clock=self.clock)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")  # b is now the least recently used
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_ttl_expiry(self):
+        """It should not return expired entries"""
+        cache = RecordCache(maxsize=2, ttl=10, clock=self.clock)
+        cache.set("a", 1)
+        self.clock.now = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_delete_and_clear(self):
+        """It should invalidate one or all entries"""
+        cache = RecordCache(maxsize=4, ttl=10, clock=self.clock)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        cache.clear()
+        self.assertIsNone(cache.get("b"))
+
+    def test_shared_backend(self):
+        """It should share entries and invalidations through the backend"""
+        backend = InMemoryBackend(clock=self.clock)
+        first = RecordCache(maxsize=4, ttl=10, backend=backend, clock=self.clock)
+        second = RecordCache(maxsize=4, ttl=10, backend=backend, clock=self.clock)
+        first.set("a", 1)
+        self.assertEqual(second.get("a"), 1)
+        self.assertEqual(second.stats()["hits"], 1)
+
+        # no process keeps a local copy that an invalidation cannot reach
+        first.delete("a")
+        self.assertIsNone(second.get("a"))
+        self.assertEqual(second.stats()["size"], 0)
+
+        first.set("b", 2)
+        self.clock.now = 10
+        self.assertIsNone(backend.get("b"))
+        first.set("c", 3)
+        first.clear()
+        self.assertIsNone(backend.get("c"))
+
+    def test_generation(self):
+        """It should not cache a value loaded before its key was invalidated"""
+        cache = RecordCache(maxsize=2, ttl=10, clock=self.clock)
+        generation = cache.generation("a")
+        cache.delete("a")  # a write lands while "a" is being loaded
+        self.assertFalse(cache.set("a", "stale", generation))
+        self.assertIsNone(cache.get("a"))
+        self.assertTrue(cache.set("a", "fresh", cache.generation("a")))
+
+        # the generation outlives eviction and clear()
+        generation = cache.generation("a")
+        cache.delete("b")
+        cache.delete("c")
+        self.assertTrue(cache.set("a", "fresh", generation))
+        cache.delete("a")
+        cache.delete("b")
+        cache.delete("c")  # evicts the generation of "a"
+        self.assertFalse(cache.set("a", "stale", generation))
+        generation = cache.generation("d")
+        cache.clear()
+        self.assertFalse(cache.set("d", "stale", generation))
+
+    def test_shared_generation(self):
+        """It should not cache a value loaded before another process invalidated it"""
+        backend = InMemoryBackend(clock=self.clock)
+        first = RecordCache(maxsize=4, ttl=10, backend=backend, clock=self.clock)
+        second = RecordCache(maxsize=4, ttl=10, backend=backend, clock=self.clock)
+        generation = first.generation("a")
+        second.delete("a")
+        self.assertFalse(first.set("a", "stale", generation))
+        self.assertIsNone(second.get("a"))
+        self.assertTrue(first.set("a", "fresh", first.generation("a")))
+        self.assertEqual(second.get("a"), "fresh")
+
+    def test_local_ttl(self):
+        """It should keep local copies of shared entries only for local_ttl"""
+        backend = InMemoryBackend(clock=self.clock)
+        first = RecordCache(maxsize=4, ttl=10, backend=backend, clock=self.clock)
+        second = RecordCache(maxsize=4, ttl=10, backend=backend, clock=self.clock, local_ttl=1)
+        first.set("a", 1)
+        self.assertEqual(second.get("a"), 1)
+        first.delete("a")
+        self.assertEqual(second.get("a"), 1)  # the local copy is stale for up to local_ttl
+        self.clock.now = 1
+        self.assertIsNone(second.get("a"))
+
+    def test_backend_interface(self):
+        """It should require backends to implement every method"""
+        backend = CacheBackend()
+        self.assertRaises(NotImplementedError, backend.get, "a")
+        self.assertRaises(NotImplementedError, backend.set, "a", 1, 10)
+        self.assertRaises(NotImplementedError, backend.delete, "a")
+        self.assertRaises(NotImplementedError, backend.clear)
+
+
+class FakeRedis:
+    """Stands in for a redis.Redis client"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, px):  # pylint: disable=unused-argument
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in list(self.data) if key.startswith(match.rstrip("*"))]
+
+
+######################################################################
+#  B A C K E N D   C O N F I G   T E S T   C A S E S
+######################################################################
+class TestMakeBackend(TestCase):
+    """Shared Backend Configuration Tests"""
+
+    def test_no_url(self):
+        """It should not share the cache without a URL"""
+        self.assertIsNone(make_backend(""))
+        self.assertIsNone(make_backend(None))
+
+    def test_unknown_url(self):
+        """It should refuse a URL it has no backend for"""
+        self.assertRaises(ValueError, make_backend, "memcached://cache:11211")
+
+    def test_redis(self):
+        """It should keep pickled values under a prefix in Redis"""
+        client = FakeRedis()
+        with patch("service.common.cache.redis") as redis:
+            redis.Redis.from_url.return_value = client
+            backend = make_backend("redis://cache:6379/0")
+        redis.Redis.from_url.assert_called_once_with("redis://cache:6379/0")
+        self.assertIsInstance(backend, RedisBackend)
+        backend.set("a", {"id": 1}, 10)
+        self.assertEqual(backend.get("a"), {"id": 1})
+        self.assertIsNone(backend.get("b"))
+        client.data["other:key"] = b"not ours"
+        backend.clear()
+        self.assertEqual(list(client.data), ["other:key"])
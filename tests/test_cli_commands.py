@@ -5,7 +5,7 @@ import os
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service.common.cli_commands import db_create, db_init, db_indexes
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +21,22 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.Account')
+    @patch('service.common.cli_commands.db')
+    def test_db_init(self, db_mock, account_mock):
+        """It should create missing tables and indexes without dropping any"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_init)
+            self.assertEqual(result.exit_code, 0)
+            db_mock.create_all.assert_called_once()
+            db_mock.drop_all.assert_not_called()
+            account_mock.create_indexes.assert_called_once()
+
+    @patch('service.common.cli_commands.Account')
+    def test_db_indexes(self, account_mock):
+        """It should call the db-indexes command"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_indexes)
+            self.assertEqual(result.exit_code, 0)
+            account_mock.create_indexes.assert_called_once()
@@ -13,6 +13,12 @@ class TestErrorHandlers(unittest.TestCase):
         self.app = app
         self.app.config['TESTING'] = True
         self.client = self.app.test_client()
+        # the handlers build responses, which needs an application context
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
 
     def _get_handler(self, key):
         """
@@ -73,6 +79,16 @@ class TestErrorHandlers(unittest.TestCase):
         self.assertEqual(rv.json['error'], "Unsupported media type")
         self.assertEqual(rv.json['message'], "Unsupported media type")
 
+    def test_precondition_failed(self):
+        """412 Precondition Failed handler"""
+        err = Exception("Account has been modified")
+        fn = self._get_handler(status.HTTP_412_PRECONDITION_FAILED)
+        rv, code = fn(err)
+        self.assertEqual(code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(rv.json['status'], status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(rv.json['error'], "Precondition Failed")
+        self.assertEqual(rv.json['message'], "Account has been modified")
+
     def test_internal_server_error(self):
         """500 Internal Server Error handler"""
         err = Exception("Test error message")
@@ -8,6 +8,12 @@ class TestUnauthorizedHandler(unittest.TestCase):
         self.app = app
         self.app.config['TESTING'] = True
         self.client = self.app.test_client()
+        # the handlers build responses, which needs an application context
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
 
     def _get_handler(self, code):
         spec = self.app.error_handler_spec[None]
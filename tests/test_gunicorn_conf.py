@@ -0,0 +1,119 @@
+"""
+Test cases for the Gunicorn configuration
+"""
+import os
+import shutil
+import logging
+import tempfile
+import importlib.util
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+from service import app
+from service.common.metrics import registry
+from service.models import db
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py")
+
+
+def load_config(**environ):
+    """Loads gunicorn.conf.py with the given environment variables"""
+    spec = importlib.util.spec_from_file_location("gunicorn_conf", CONFIG_PATH)
+    module = importlib.util.module_from_spec(spec)
+    with patch.dict(os.environ, environ):
+        spec.loader.exec_module(module)
+    return module
+
+
+######################################################################
+#  G U N I C O R N   C O N F I G   T E S T   C A S E S
+######################################################################
+class TestGunicornConfig(TestCase):
+    """Gunicorn Configuration Tests"""
+
+    def test_defaults(self):
+        """It should size gthread workers from the CPU count"""
+        with patch("multiprocessing.cpu_count", return_value=4):
+            config = load_config(PORT="9000", SERVER_MODE="wsgi")
+        self.assertEqual(config.wsgi_app, "service:app")
+        self.assertEqual(config.bind, "0.0.0.0:9000")
+        self.assertEqual(config.worker_class, "gthread")
+        self.assertEqual(config.workers, 9)
+        self.assertEqual(config.threads, 4)
+        self.assertTrue(config.preload_app)
+
+    def test_worker_classes(self):
+        """It should pick settings that suit each worker class"""
+        with patch("multiprocessing.cpu_count", return_value=4):
+            config = load_config(SERVER_MODE="wsgi", GUNICORN_WORKER_CLASS="gevent")
+        self.assertEqual(config.workers, 4)
+        self.assertEqual(config.threads, 1)
+        self.assertFalse(config.preload_app)
+
+        config = load_config(SERVER_MODE="asgi")
+        self.assertEqual(config.wsgi_app, "service.asgi:app")
+        self.assertEqual(config.worker_class, "uvicorn.workers.UvicornWorker")
+
+    def test_environment_overrides(self):
+        """It should let the environment override the sizing"""
+        config = load_config(
+            SERVER_MODE="wsgi", GUNICORN_WORKERS="2", GUNICORN_THREADS="8",
+            GUNICORN_PRELOAD="false", GUNICORN_MAX_REQUESTS="1000",
+        )
+        self.assertEqual(config.workers, 2)
+        self.assertEqual(config.threads, 8)
+        self.assertFalse(config.preload_app)
+        self.assertEqual(config.max_requests_jitter, 100)
+
+    def test_pool_settings(self):
+        """It should size each worker's pool from its threads within the connection budget"""
+        with patch("multiprocessing.cpu_count", return_value=8):
+            config = load_config(SERVER_MODE="wsgi")
+        # 17 workers share 90 connections: one per thread and one spare each
+        self.assertEqual((config.database_pool_size, config.database_max_overflow), (4, 1))
+        self.assertLessEqual(config.workers * (config.database_pool_size + config.database_max_overflow), 90)
+
+        config = load_config(
+            SERVER_MODE="wsgi", GUNICORN_WORKERS="17", GUNICORN_THREADS="8",
+            DATABASE_POOL_SIZE="10", DATABASE_MAX_OVERFLOW="10", DATABASE_MAX_CONNECTIONS="100",
+        )
+        self.assertEqual((config.database_pool_size, config.database_max_overflow), (5, 0))
+        self.assertEqual(config.pool_settings(2, 4, "gthread", max_connections=100), (4, 2))
+        self.assertEqual(config.pool_settings(2, 1, "gevent", max_connections=100), (5, 10))
+
+    def test_post_fork_disposes_engine(self):
+        """It should discard the inherited connection pool after fork"""
+        config = load_config(SERVER_MODE="wsgi")
+        engine = db.get_engine(app)
+        with patch.object(type(engine), "dispose") as dispose:
+            config.post_fork(MagicMock(), MagicMock())
+        dispose.assert_called_once_with(close=False)
+
+    def test_metrics_dir_hooks(self):
+        """It should clear METRICS_DIR on start and drop the gauges of exited workers"""
+        directory = os.path.join(tempfile.mkdtemp(), "metrics")
+        config = load_config(SERVER_MODE="wsgi", GUNICORN_WORKERS="2", METRICS_DIR=directory)
+        with patch.dict(os.environ, {"METRICS_DIR": directory}):
+            config.on_starting(MagicMock())
+            registry.write(directory, pid=1001)
+            config.on_starting(MagicMock())  # a restarted server starts from zero
+            self.assertEqual(os.listdir(directory), [])
+            registry.write(directory, pid=1001)
+            with patch.object(registry, "mark_process_dead") as mark_process_dead:
+                config.child_exit(MagicMock(), MagicMock(pid=1001))
+            mark_process_dead.assert_called_once_with(directory, 1001)
+        shutil.rmtree(os.path.dirname(directory))
+
+    def test_post_worker_init_logging(self):
+        """It should send Flask logs through the gunicorn error log"""
+        config = load_config(SERVER_MODE="wsgi")
+        handler = logging.NullHandler()
+        gunicorn_logger = logging.getLogger("gunicorn.error")
+        gunicorn_logger.addHandler(handler)
+        saved = (app.logger.handlers, app.logger.propagate, app.logger.level)
+        try:
+            config.post_worker_init(MagicMock())
+            self.assertIn(handler, app.logger.handlers)
+        finally:
+            gunicorn_logger.removeHandler(handler)
+            app.logger.handlers, app.logger.propagate, level = saved
+            app.logger.setLevel(level)
@@ -3,17 +3,23 @@ from unittest.mock import patch
 import sys
 
 class TestServiceInit(unittest.TestCase):
-    def test_init_db_failure_exits(self):
-        # Patch models.init_db to raise an Exception
-        with patch('service.models.init_db', side_effect=Exception('DB fail')):
-            # Patch sys.exit to raise SystemExit so we can catch it
+    def test_import_does_not_touch_database(self):
+        # Patch models.init_db to raise an Exception if anything calls it
+        with patch('service.models.init_db', side_effect=Exception('DB fail')) as mock_init_db:
+            # Patch sys.exit so that a failed startup would be caught
             with patch.object(sys, 'exit', side_effect=SystemExit(4)) as mock_exit:
-                with self.assertRaises(SystemExit) as cm:
-                    # Importing service.__init__ will run the code
-                    import importlib
-                    importlib.reload(__import__('service.__init__'))
-                self.assertEqual(cm.exception.code, 4)
-                mock_exit.assert_called_once_with(4)
+                # Importing service.__init__ will run the code
+                import importlib
+                importlib.reload(__import__('service.__init__'))
+                mock_init_db.assert_not_called()
+                mock_exit.assert_not_called()
+
+    def test_create_app_overrides_config(self):
+        from service import create_app
+        app = create_app({'ACCOUNTS_PAGE_SIZE': 7})
+        self.assertEqual(app.config['ACCOUNTS_PAGE_SIZE'], 7)
+        self.assertIn('accounts.list_accounts', app.view_functions)
+        self.assertIn('db-init', app.cli.commands)
 
 if __name__ == '__main__':  # pragma: no cover
-    unittest.main() 
\ No newline at end of file
+    unittest.main()
@@ -5,8 +5,8 @@ from unittest.mock import patch
 
 class TestServiceInitSuccess(unittest.TestCase):
     def test_init_db_success(self):
-        # Patch init_db so it doesn't raise
-        with patch('service.models.init_db', return_value=None):
+        # Patch init_app so it doesn't raise
+        with patch('service.models.init_app', return_value=None):
             called = []
             # Patch sys.exit so it just records calls
             with patch.object(sys, 'exit', side_effect=lambda code: called.append(code)):
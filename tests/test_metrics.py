@@ -0,0 +1,151 @@
+"""
+Test cases for the Metrics registry
+"""
+import atexit
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase
+from service.common.metrics import Counter, Gauge, Histogram, Registry, clear_directory
+
+
+######################################################################
+#  M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestMetrics(TestCase):
+    """Test Cases for the Prometheus-style metrics"""
+
+    def test_counter(self):
+        """It should count per label set"""
+        counter = Counter("hits_total", "Hits", ("route",))
+        counter.inc(route="/a")
+        counter.inc(2, route="/a")
+        counter.inc(route="/b")
+        self.assertEqual(counter.get(route="/a"), 3)
+        self.assertEqual(counter.get(route="/c"), 0)
+        lines = counter.expose()
+        self.assertEqual(lines[0], "# HELP hits_total Hits")
+        self.assertEqual(lines[1], "# TYPE hits_total counter")
+        self.assertIn('hits_total{route="/a"} 3', lines)
+        self.assertIn('hits_total{route="/b"} 1', lines)
+
+    def test_gauge(self):
+        """It should go up and down"""
+        gauge = Gauge("in_flight", "In flight")
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(gauge.get(), 1)
+        self.assertIn("in_flight 1", gauge.expose())
+        self.assertIn("# TYPE in_flight gauge", gauge.expose())
+
+    def test_histogram(self):
+        """It should count observations in cumulative buckets"""
+        histogram = Histogram("latency", "Latency", ("route",), buckets=(0.1, 1))
+        histogram.observe(0.05, route="/a")
+        histogram.observe(0.5, route="/a")
+        histogram.observe(5, route="/a")
+        sample = histogram.get(route="/a")
+        self.assertEqual(sample["buckets"], [1, 2])
+        self.assertEqual(sample["count"], 3)
+        self.assertAlmostEqual(sample["sum"], 5.55)
+        self.assertIsNone(histogram.get(route="/b"))
+        lines = histogram.expose()
+        self.assertIn('latency_bucket{route="/a",le="0.1"} 1', lines)
+        self.assertIn('latency_bucket{route="/a",le="1.0"} 2', lines)
+        self.assertIn('latency_bucket{route="/a",le="+Inf"} 3', lines)
+        self.assertIn('latency_count{route="/a"} 3', lines)
+
+    def test_label_escaping(self):
+        """It should escape quotes and backslashes in label values"""
+        counter = Counter("c", "C", ("route",))
+        counter.inc(route='a"b\\c')
+        self.assertIn('c{route="a\\"b\\\\c"} 1', counter.expose())
+
+    def test_registry(self):
+        """It should expose and clear every registered metric"""
+        registry = Registry()
+        counter = registry.register(Counter("a_total", "A"))
+        counter.inc()
+        text = registry.expose()
+        self.assertTrue(text.endswith("\n"))
+        self.assertIn("a_total 1", text)
+        registry.clear()
+        self.assertEqual(counter.get(), 0)
+
+
+######################################################################
+#  M U L T I P R O C E S S   T E S T   C A S E S
+######################################################################
+class TestMultiprocessMetrics(TestCase):
+    """Test Cases for adding up the metrics of several worker processes"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.registry = Registry()
+        self.hits = self.registry.register(Counter("hits_total", "Hits", ("route",)))
+        self.in_flight = self.registry.register(Gauge("in_flight", "In flight"))
+        self.latency = self.registry.register(Histogram("latency", "Latency", buckets=(0.1, 1)))
+
+    def tearDown(self):
+        clear_directory(self.directory)
+        os.rmdir(self.directory)
+
+    def test_expose_adds_up_workers(self):
+        """It should add the samples other workers wrote to those of this process"""
+        self.hits.inc(2, route="/a")
+        self.in_flight.inc()
+        self.latency.observe(0.5)
+        self.registry.write(self.directory, pid=1001)  # another worker with the same samples
+        self.registry.write(self.directory)  # this process is exposed from memory instead
+        self.hits.inc(route="/b")
+
+        text = self.registry.expose(self.directory)
+        self.assertIn('hits_total{route="/a"} 4', text)
+        self.assertIn('hits_total{route="/b"} 1', text)
+        self.assertIn("in_flight 2", text)
+        self.assertIn('latency_bucket{le="1.0"} 2', text)
+        self.assertIn("latency_count 2", text)
+        # without the directory only this process is exposed
+        self.assertIn('hits_total{route="/a"} 2', self.registry.expose())
+
+    def test_mark_process_dead(self):
+        """It should fold the counts of exited workers into one file and drop their gauges"""
+        self.hits.inc(route="/a")
+        self.in_flight.inc()
+        self.latency.observe(0.5)
+        self.registry.write(self.directory, pid=1001)
+        self.registry.write(self.directory, pid=1002)
+        self.registry.mark_process_dead(self.directory, 1001)
+        self.registry.mark_process_dead(self.directory, 1002)
+        self.registry.mark_process_dead(self.directory, 1003)  # never wrote anything
+        self.assertEqual(os.listdir(self.directory), ["metrics-exited.json"])
+        with open(os.path.join(self.directory, "metrics-exited.json"), encoding="utf-8") as file:
+            exited = json.load(file)
+        self.assertEqual(set(exited), {"hits_total", "latency"})
+
+        other = Registry()
+        other.register(Counter("hits_total", "Hits", ("route",)))
+        other.register(Gauge("in_flight", "In flight"))
+        other.register(Histogram("latency", "Latency", buckets=(0.1, 1)))
+        text = other.expose(self.directory)
+        self.assertIn('hits_total{route="/a"} 2', text)
+        self.assertIn("in_flight", text)
+        self.assertNotIn("in_flight 1", text)
+        self.assertIn("latency_count 2", text)
+
+    def test_writer(self):
+        """It should write the samples of this process in the background"""
+        self.hits.inc(route="/a")
+        self.registry.start_writer(self.directory, interval=60)
+        self.registry.start_writer(self.directory, interval=60)  # one writer per process
+        # pylint: disable=protected-access
+        self.addCleanup(atexit.unregister, self.registry._try_write)
+        path = os.path.join(self.directory, f"metrics-{os.getpid()}.json")
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.01)
+        with open(path, encoding="utf-8") as file:
+            self.assertEqual(json.load(file)["hits_total"], [[["/a"], 1]])
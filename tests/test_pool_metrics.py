@@ -0,0 +1,82 @@
+"""
+Test cases for the Connection Pool Metrics
+"""
+import threading
+from unittest import TestCase
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+from service.common.pool_metrics import (
+    PoolMetrics, TimedQueuePool, MeteredSQLAlchemy, pool_metrics
+)
+
+
+######################################################################
+#  P O O L   M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestPoolMetrics(TestCase):
+    """Test Cases for PoolMetrics"""
+
+    def test_pool_events(self):
+        """It should count connects, checkouts and checkins"""
+        metrics = PoolMetrics()
+        engine = create_engine("sqlite://", poolclass=TimedQueuePool, pool_size=2)
+        metrics.register(engine)
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            stats = metrics.stats(engine)
+            self.assertEqual(stats["connects"], 1)
+            self.assertEqual(stats["checked_out"], 1)
+            self.assertEqual(stats["size"], 2)
+            self.assertIn("overflow", stats)
+        stats = metrics.stats(engine)
+        self.assertEqual(stats["checkouts"], 1)
+        self.assertEqual(stats["checkins"], 1)
+        self.assertEqual(stats["checked_out"], 0)
+
+        with engine.connect() as conn:
+            conn.invalidate()
+        self.assertEqual(metrics.stats()["invalidations"], 1)
+        engine.dispose()
+
+    def test_record_wait(self):
+        """It should record the time spent waiting for a connection"""
+        metrics = PoolMetrics()
+        metrics.record_wait(0.5)
+        metrics.record_wait(1.5)
+        stats = metrics.stats()
+        self.assertEqual(stats["wait_time_total"], 2.0)
+        self.assertEqual(stats["wait_time_max"], 1.5)
+        self.assertEqual(stats["wait_time_avg"], 1.0)
+        metrics.reset()
+        self.assertEqual(metrics.stats()["wait_time_avg"], 0.0)
+
+    def test_timed_queue_pool(self):
+        """It should time the checkouts that found no idle connection"""
+        waits = pool_metrics.waits
+        engine = create_engine("sqlite://", poolclass=TimedQueuePool, pool_size=1, max_overflow=0)
+        with engine.connect():
+            pass  # the first checkout opens the connection
+        self.assertEqual(pool_metrics.waits, waits + 1)
+        with engine.connect():
+            pass  # the idle connection is reused without waiting
+        self.assertEqual(pool_metrics.waits, waits + 1)
+
+        # a checkout blocks while the only connection is in use
+        held = engine.connect()
+        threading.Timer(0.1, held.close).start()
+        with engine.connect():
+            pass
+        self.assertEqual(pool_metrics.waits, waits + 2)
+        self.assertGreaterEqual(pool_metrics.max_wait_time, 0.05)
+        engine.dispose()
+
+    def test_metered_sqlalchemy(self):
+        """It should use the timed pool unless a pool class is configured"""
+        extension = MeteredSQLAlchemy()
+        engine = extension.create_engine(make_url("sqlite://"), {})
+        self.assertIsInstance(engine.pool, TimedQueuePool)
+        engine.dispose()
+        engine = extension.create_engine(make_url("sqlite://"), {"poolclass": NullPool})
+        self.assertIsInstance(engine.pool, NullPool)
+        engine.dispose()
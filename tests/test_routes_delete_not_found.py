@@ -1,8 +1,13 @@
 import unittest
 from service import app
 from service.common import status
+from service.models import init_db
 
 class TestRoutesDeleteNotFound(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        init_db(app)  # the tables are no longer created on import
+
     def setUp(self):
         self.app = app
         self.app.config['TESTING'] = True